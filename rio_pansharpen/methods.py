@@ -3,7 +3,15 @@ import numpy as np
 
 
 def calculateRatio(rgb, pan, weight):
-    return pan / ((rgb[0] + rgb[1] + rgb[2] * weight) / (2 + weight))
+    """Ratio of pan to the synthetic pan band, a weighted average of
+    the color bands. A scalar weight is the blue weight of a 3 band
+    (red, green, blue) array; a sequence gives one weight per band.
+    """
+    if np.ndim(weight) == 0 and len(rgb) == 3:
+        return pan / ((rgb[0] + rgb[1] + rgb[2] * weight) / (2 + weight))
+
+    weights = np.asarray(weight, dtype=np.float32)
+    return pan / (np.tensordot(weights, rgb, axes=1) / weights.sum())
 
 
 def Brovey(rgb, pan, weight, pan_dtype):
@@ -11,10 +19,36 @@ def Brovey(rgb, pan, weight, pan_dtype):
     Brovey Method: Each resampled, multispectral pixel is
     multiplied by the ratio of the corresponding
     panchromatic pixel intensity to the sum of all the
-    multispectral intensities.
+    multispectral intensities. Works on any number of bands.
     """
     with np.errstate(invalid='ignore', divide='ignore'):
         ratio = calculateRatio(rgb, pan, weight)
     with np.errstate(invalid='ignore'):
         sharp = np.clip(ratio * rgb, 0, np.iinfo(pan_dtype).max)
         return sharp.astype(pan_dtype), ratio
+
+
+def BroveyUint8(rgb, pan, weight, out=None):
+    """
+    Brovey Method for 16 bit inputs, straight to 8 bit output:
+    the 16 to 8 bit rescale is folded into the ratio, so each band
+    takes one float32 multiply and is truncated once into `out`.
+    Matches Brovey followed by a divide by 257 within 1 DN.
+
+    Returns the 8 bit bands and a boolean array of pixels whose
+    16 bit Brovey value is nonzero in at least one band.
+    """
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ratio = calculateRatio(rgb, pan, weight)
+    ratio *= np.float32(1 / 257.0)
+    with np.errstate(invalid='ignore'):
+        sharp = ratio * rgb
+        valid = np.any(sharp >= np.float32(1 / 257.0), axis=0)
+    # fmax/fmin also map NaN (0 / 0 ratios) to 0
+    np.fmin(np.fmax(sharp, 0, out=sharp), 255, out=sharp)
+
+    if out is None:
+        out = np.empty(sharp.shape, dtype=np.uint8)
+    np.copyto(out, sharp, casting='unsafe')
+
+    return out, valid
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+"""Read-ahead of upcoming windows for latency-bound (remote) inputs.
+
+An asyncio loop on a background thread keeps reads of the next few
+windows in flight on a small thread pool, the "connection pool", while
+the caller computes on the current window. GDAL turns each read into
+ranged requests for the tiles it touches; rasterio releases the GIL
+while it waits, so the reads overlap.
+"""
+from __future__ import division
+
+import asyncio
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import rasterio
+
+
+_DONE = object()
+
+
+class _Prefetcher(object):
+    """Iterates over (item, read(open_files, item)) in order, with up
+    to `depth` reads running ahead on `concurrency` threads
+    """
+    def __init__(self, src_paths, read, items, depth=4, concurrency=4):
+        self.src_paths = src_paths
+        # rasterio datasets must not be shared between threads
+        self.local = threading.local()
+        self.opened = []
+        self.read = read
+        self.items = items
+        self.depth = max(int(depth), 1)
+        self.concurrency = max(int(concurrency), 1)
+        self.results = queue.Queue(maxsize=self.depth)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+
+    def _read(self, item):
+        open_files = getattr(self.local, 'open_files', None)
+        if open_files is None:
+            open_files = [rasterio.open(path) for path in self.src_paths]
+            self.local.open_files = open_files
+            self.opened.extend(open_files)
+        return self.read(open_files, item)
+
+    def _run(self):
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(self._produce(loop))
+        finally:
+            loop.close()
+            for src in self.opened:
+                src.close()
+
+    async def _emit(self, loop, entry):
+        # a blocking put on a spare thread gives backpressure
+        # without stalling the reads already in flight
+        await loop.run_in_executor(None, self.results.put, entry)
+
+    async def _produce(self, loop):
+        with ThreadPoolExecutor(self.concurrency) as pool:
+            pending = deque()
+            try:
+                for item in self.items:
+                    if self.stopped.is_set():
+                        return
+                    pending.append(
+                        (item, loop.run_in_executor(pool, self._read, item)))
+                    if len(pending) > self.depth:
+                        item, future = pending.popleft()
+                        await self._emit(loop, (item, await future, None))
+                while pending and not self.stopped.is_set():
+                    item, future = pending.popleft()
+                    await self._emit(loop, (item, await future, None))
+            except Exception as exc:
+                for _, future in pending:
+                    future.cancel()
+                await self._emit(loop, (None, None, exc))
+                return
+            await self._emit(loop, (_DONE, None, None))
+
+    def __iter__(self):
+        self.thread.start()
+        try:
+            while True:
+                item, data, exc = self.results.get()
+                if exc is not None:
+                    raise exc
+                if item is _DONE:
+                    return
+                yield item, data
+        finally:
+            self.stopped.set()
+            # unblock a producer waiting on a full queue
+            while self.thread.is_alive():
+                try:
+                    self.results.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+
+
+def prefetch(src_paths, read, items, depth=4, concurrency=4):
+    """Yields (item, read(open_files, item)) for each item, in order,
+    while the reads of the next `depth` items run concurrently
+
+    Parameters
+    ------------
+    src_paths: list of string
+        paths or GDAL URLs (/vsicurl/, /vsis3/) opened once per thread
+    read: function
+        read(open_files, item) returning the data for item
+    items: iterable
+    depth: integer
+        number of items read ahead
+    concurrency: integer
+        number of reads in flight at once
+    """
+    return iter(_Prefetcher(src_paths, read, items, depth, concurrency))
@@ -1,10 +1,18 @@
 #!/usr/bin/env python
 
 import click
-from rio_pansharpen.worker import calculate_landsat_pansharpen
 from rasterio.rio.options import creation_options
 
 
+# command line flags of the worker options, for error messages
+_FLAGS = {
+    'shards': '--shards', 'shard_dir': '--shard-dir', 'update': '--update',
+    'bounds': '--bounds', 'record_inputs': '--record-inputs',
+    'prefetch': '--prefetch', 'color_bands': '--bidx',
+    'balance': '--balance', 'checksums': '--checksums',
+    'half_window': '--half-window', 'max_memory': '--max-memory'}
+
+
 @click.command('pansharpen')
 @click.argument('src_paths', type=click.Path(exists=True), nargs=-1)
 @click.argument('dst_path', type=click.Path(exists=False), nargs=1)
@@ -12,6 +20,9 @@ from rasterio.rio.options import creation_options
               default='uint8')
 @click.option('--weight', '-w', default=0.2,
               help="Weight of blue band [default = 0.2]")
+@click.option('--band-weights', default=None,
+              help="Comma separated weight of each color band in the "
+              "synthetic pan band, overrides --weight")
 @click.option('--verbosity', '-v', is_flag=True)
 @click.option('--jobs', '-j', default=1,
               help="Number of processes [default = 1]")
@@ -27,11 +38,60 @@ from rasterio.rio.options import creation_options
               "[default=src_blockswindows]")
 @click.option('--out-alpha/--no-out-alpha', default=True, is_flag=True,
               help="Output an alpha band along with RGB")
+@click.option('--shards', default=1,
+              help="Split the scene into shards written separately and "
+              "assembled into DST_PATH (GeoTIFF or .vrt) [default = 1]")
+@click.option('--shard-dir', type=click.Path(file_okay=False), default=None,
+              help="Directory the shards are written to [default = the "
+              "directory of DST_PATH]")
+@click.option('--update', is_flag=True, default=False,
+              help="Recompute, in place, only the windows of an existing "
+              "DST_PATH intersecting --bounds or whose inputs changed "
+              "since --record-inputs")
+@click.option('--bounds', nargs=4, type=float, default=None,
+              help="Bounds to update: left bottom right top, in the "
+              "pan CRS")
+@click.option('--record-inputs', is_flag=True, default=False,
+              help="Store per-window input checksums next to DST_PATH "
+              "for later --update runs")
+@click.option('--prefetch', default=0,
+              help="Windows to read ahead concurrently per shard, for "
+              "remote inputs; implies at least --jobs shards "
+              "[default = 0]")
+@click.option('--bidx', default=None,
+              help="Comma separated band indexes to sharpen when the color "
+              "input is a single multiband file or VRT, e.g. 3,2,1 "
+              "[default = all bands]")
+@click.option('--balance', is_flag=True, default=False,
+              help="Split expensive windows, process them largest "
+              "estimated cost first and report per-worker utilization")
+@click.option('--checksums', is_flag=True, default=False,
+              help="Write per-window output checksums to "
+              "DST_PATH.checksums.json")
+@click.option('--compare-to', type=click.Path(exists=True), default=None,
+              help="Compare the output window by window with another "
+              "run's output and fail on differences over --tolerance")
+@click.option('--tolerance', default=0,
+              help="Max absolute difference allowed by --compare-to "
+              "[default = 0]")
+@click.option('--max-memory', type=int, default=None,
+              help="Megabytes of window data allowed in flight across "
+              "workers and the writer queue; reports peak RSS per process")
+@click.option('--mosaic', default=0,
+              help="Mosaic overlapping scenes of this many input files "
+              "each (pan first) into DST_PATH in one pass [default = 0]")
+@click.option('--composite', type=click.Choice(['first', 'best']),
+              default='first',
+              help="Mosaic pixels from the first scene covering them, or "
+              "from the scenes covering most of each window first")
 @creation_options
 def pansharpen(
         src_paths, dst_path, dst_dtype,
-        weight, verbosity, jobs,
-        half_window, customwindow, out_alpha, creation_options):
+        weight, band_weights, verbosity, jobs,
+        half_window, customwindow, out_alpha, shards, update, bounds,
+        record_inputs, prefetch, bidx, balance, checksums, compare_to,
+        tolerance, max_memory, mosaic, composite, shard_dir,
+        creation_options):
     """Pansharpens a landsat scene.
     Input is a panchromatic band, plus 3 color bands
 
@@ -40,13 +100,110 @@ def pansharpen(
     Or with shell expansion
 
        pansharpen LC80410332015283LGN00_B{8,4,3,2}.tif out.tif
+
+    Any number of color bands can be sharpened in one pass,
+    given a weight for each
+
+       pansharpen B{8,5,4,3,2}.tif out.tif --band-weights 0.1,1,1,0.2
+
+    Color bands can also come from one multiband file or VRT
+
+       pansharpen B8.tif rgb.vrt out.tif --bidx 3,2,1
+
+    Overlapping scenes can be mosaicked into one output in one pass,
+    given the number of input files per scene
+
+       pansharpen s1_B{8,4,3,2}.tif s2_B{8,4,3,2}.tif out.tif --mosaic 4
+
+    A DST_PATH ending in .zarr is written as a chunked Zarr array,
+    one chunk per window, for analysis pipelines (needs zarr)
+
+       pansharpen B{8,4,3,2}.tif out.zarr -j 4
     """
     if customwindow != 0 and customwindow < 150:
         raise click.BadParameter(
             'custom blocksize must be greater than 150',
             param=customwindow, param_hint='--customwindow')
 
-    return calculate_landsat_pansharpen(
-        src_paths, dst_path, dst_dtype, weight, verbosity,
-        jobs, half_window, customwindow, out_alpha, creation_options
-      )
+    color_bands = None
+    if bidx:
+        try:
+            color_bands = [int(b) for b in bidx.split(',')]
+        except ValueError:
+            raise click.BadParameter(
+                'band indexes must be comma separated integers',
+                param=bidx, param_hint='--bidx')
+
+    if band_weights:
+        try:
+            weight = [float(w) for w in band_weights.split(',')]
+        except ValueError:
+            raise click.BadParameter(
+                'band weights must be comma separated numbers',
+                param=band_weights, param_hint='--band-weights')
+
+    if max_memory is not None and max_memory < 1:
+        raise click.BadParameter(
+            'max memory must be at least 1 MB',
+            param=max_memory, param_hint='--max-memory')
+
+    if shards < 1:
+        raise click.BadParameter(
+            'shards must be at least 1',
+            param=shards, param_hint='--shards')
+
+    if mosaic and (mosaic < 2 or len(src_paths) % mosaic):
+        raise click.BadParameter(
+            'inputs must be whole scenes of a pan and color files',
+            param=mosaic, param_hint='--mosaic')
+
+    from rio_pansharpen.utils import _output_backend
+    if compare_to and _output_backend(dst_path) == 'zarr':
+        raise click.BadParameter(
+            'only GeoTIFF outputs can be compared',
+            param=compare_to, param_hint='--compare-to')
+
+    options = dict(
+        shards=shards, shard_dir=shard_dir, update=update,
+        bounds=bounds or None, record_inputs=record_inputs,
+        prefetch=prefetch, color_bands=color_bands, balance=balance,
+        checksums=checksums,
+        max_memory=max_memory * 2 ** 20 if max_memory else None)
+
+    # rio imports every plugin on startup, so the worker module and its
+    # heavy dependencies (riomucho, rasterio.warp, asyncio) are only
+    # imported when pansharpen actually runs
+    from rio_pansharpen import worker
+    try:
+        if mosaic:
+            worker._select_runner(
+                'gtiff', dict(options, half_window=half_window), mosaic=True)
+            worker.calculate_mosaic_pansharpen(
+                [src_paths[i:i + mosaic]
+                 for i in range(0, len(src_paths), mosaic)],
+                dst_path, dst_dtype, weight, jobs=jobs,
+                composite=composite, customwindow=customwindow,
+                out_alpha=out_alpha, creation_opts=creation_options,
+                verbosity=verbosity, checksums=checksums)
+        else:
+            worker.calculate_landsat_pansharpen(
+                src_paths, dst_path, dst_dtype, weight, verbosity,
+                jobs, half_window, customwindow, out_alpha,
+                creation_options, **options)
+    except worker._UnsupportedOptions as exc:
+        raise click.BadParameter(
+            'not supported by %s' % exc.runner.name,
+            param_hint=', '.join(_FLAGS.get(name, name)
+                                 for name in exc.options))
+
+    if compare_to:
+        from rio_pansharpen.verify import compare_outputs
+        diffs = compare_outputs(dst_path, compare_to)
+        failed = sorted(
+            key for key, diff in diffs.items() if diff > tolerance)
+        for key in failed:
+            click.echo('window %s: max abs diff %d' % (key, diffs[key]))
+        if failed:
+            raise click.ClickException(
+                '%d of %d windows differ from %s by more than %d' % (
+                    len(failed), len(diffs), compare_to, tolerance))
@@ -2,6 +2,13 @@
 # pylint: disable=E1120
 from __future__ import division
 
+import hashlib
+import os
+import sys
+import threading
+from collections import OrderedDict
+from xml.sax.saxutils import escape
+
 import numpy as np
 from affine import Affine
 from rasterio.enums import Resampling
@@ -21,10 +28,12 @@ def _adjust_block_size(width, height, blocksize):
 
 def _make_windows(width, height, blocksize):
     """Manually makes windows of size equivalent to
-    pan band image
+    pan band image, in row-major order, the order GDAL lays out
+    destination blocks; with several jobs, results are still
+    written in the order they complete
     """
-    for x in range(0, width, blocksize):
-        for y in range(0, height, blocksize):
+    for y in range(0, height, blocksize):
+        for x in range(0, width, blocksize):
             yield ((y, min((y + blocksize), height)),
                    (x, min((x + blocksize), width)))
 
@@ -135,6 +144,507 @@ def _calc_windows(pan_src, customwindow):
     return windows
 
 
+def _cache_tile_shape(block_shape, minsize=256):
+    """Round a source block shape up to a multiple of itself
+    that is at least minsize on each side, so striped
+    sources are cached in reasonably sized tiles
+    """
+    return tuple(
+        -(-minsize // b) * b for b in block_shape)
+
+
+def _block_range(window, tile_shape):
+    """Computes the (first, last) tile row and column
+    touched by a window
+    """
+    return tuple(
+        (w[0] // t, (w[1] - 1) // t)
+        for w, t in zip(window, tile_shape))
+
+
+def _group_windows(windows, scale, tile_shape, max_pixels=None):
+    """Groups pan windows by the rgb tile their origin falls in,
+    merging each group into windows of at most max_pixels (by default
+    4 of the largest input windows) when the group tiles a rectangle,
+    so neighboring pan windows share one rgb read
+    """
+    if max_pixels is None:
+        max_pixels = 4 * max(
+            [(w[0][1] - w[0][0]) * (w[1][1] - w[1][0]) for w, _ in windows]
+            or [0])
+
+    groups = OrderedDict()
+    for window, ij in windows:
+        key = tuple(
+            int(w[0] * s) // t
+            for w, s, t in zip(window, scale, tile_shape))
+        groups.setdefault(key, []).append((window, ij))
+
+    grouped = []
+    for key in sorted(groups):
+        members = groups[key]
+        rows = sorted(set(w[0] for w, _ in members))
+        cols = sorted(set(w[1] for w, _ in members))
+        area = sum((w[0][1] - w[0][0]) * (w[1][1] - w[1][0])
+                   for w, _ in members)
+        bounds_area = (rows[-1][1] - rows[0][0]) * (cols[-1][1] - cols[0][0])
+        if len(rows) * len(cols) != len(members) or area != bounds_area:
+            grouped.extend(members)
+            continue
+
+        # tile the group with blocks of member windows, as square as
+        # the group allows, that stay within max_pixels
+        largest = max((w[0][1] - w[0][0]) * (w[1][1] - w[1][0])
+                      for w, _ in members)
+        count = max(max_pixels // largest, 1)
+        nrows = max(min(len(rows), int(np.sqrt(count))), 1)
+        ncols = max(min(len(cols), count // nrows), 1)
+        ij = dict((window, ij) for window, ij in members)
+        for r in range(0, len(rows), nrows):
+            for c in range(0, len(cols), ncols):
+                block_rows = rows[r:r + nrows]
+                block_cols = cols[c:c + ncols]
+                grouped.append((
+                    ((block_rows[0][0], block_rows[-1][1]),
+                     (block_cols[0][0], block_cols[-1][1])),
+                    ij[(block_rows[0], block_cols[0])]))
+
+    return grouped
+
+
+class _BlockCache(object):
+    """Small, thread-safe LRU cache of decoded source tiles, bounded
+    by tile count and, optionally, by bytes; the newest tile is kept
+    even when it alone is larger than maxbytes
+    """
+    def __init__(self, maxsize, maxbytes=None):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.nbytes = 0
+        self._tiles = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            tile = self._tiles.pop(key, None)
+            if tile is not None:
+                self._tiles[key] = tile
+            return tile
+
+    def put(self, key, tile):
+        with self._lock:
+            old = self._tiles.pop(key, None)
+            if old is not None:
+                self.nbytes -= old.nbytes
+            self._tiles[key] = tile
+            self.nbytes += tile.nbytes
+            while len(self._tiles) > 1 and (
+                    len(self._tiles) > self.maxsize or
+                    (self.maxbytes is not None and
+                     self.nbytes > self.maxbytes)):
+                self.nbytes -= self._tiles.popitem(last=False)[1].nbytes
+
+    def clear(self):
+        with self._lock:
+            self._tiles.clear()
+            self.nbytes = 0
+
+
+def _read_cached(src, indexes, window, cache, out=None):
+    """Reads a possibly out of bounds window from src, assembling
+    it from cached tiles; pixels outside the dataset are 0
+    """
+    window = tuple((int(w[0]), int(w[1])) for w in window)
+    shape = (window[0][1] - window[0][0], window[1][1] - window[1][0])
+    if out is None:
+        out = np.zeros((len(indexes),) + shape, dtype=src.dtypes[0])
+    else:
+        out[:] = 0
+
+    clipped = tuple(
+        (max(w[0], 0), min(w[1], size))
+        for w, size in zip(window, (src.height, src.width)))
+    if clipped[0][0] >= clipped[0][1] or clipped[1][0] >= clipped[1][1]:
+        return out
+
+    tile_shape = _cache_tile_shape(src.block_shapes[0])
+    (r0, r1), (c0, c1) = _block_range(clipped, tile_shape)
+    for i in range(r0, r1 + 1):
+        for j in range(c0, c1 + 1):
+            key = (src.name, tuple(indexes), i, j)
+            tile = cache.get(key)
+            tile_window = (
+                (i * tile_shape[0],
+                 min((i + 1) * tile_shape[0], src.height)),
+                (j * tile_shape[1],
+                 min((j + 1) * tile_shape[1], src.width)))
+            if tile is None:
+                tile = src.read(list(indexes), window=tile_window)
+                cache.put(key, tile)
+
+            rows = (max(tile_window[0][0], clipped[0][0]),
+                    min(tile_window[0][1], clipped[0][1]))
+            cols = (max(tile_window[1][0], clipped[1][0]),
+                    min(tile_window[1][1], clipped[1][1]))
+            out[:,
+                rows[0] - window[0][0]:rows[1] - window[0][0],
+                cols[0] - window[1][0]:cols[1] - window[1][0]] = tile[
+                :,
+                rows[0] - tile_window[0][0]:rows[1] - tile_window[0][0],
+                cols[0] - tile_window[1][0]:cols[1] - tile_window[1][0]]
+
+    return out
+
+
+def _transform_window(window, fr_transform, to_transform):
+    """Computes the window of a raster georeferenced by to_transform
+    covering a window of a raster georeferenced by fr_transform
+    """
+    fr_to = ~to_transform * fr_transform
+    xs, ys = zip(*[fr_to * (col, row)
+                   for row in window[0] for col in window[1]])
+    return ((int(np.floor(min(ys))), int(np.ceil(max(ys)))),
+            (int(np.floor(min(xs))), int(np.ceil(max(xs)))))
+
+
+def _bounds_window(bounds, transform):
+    """Computes the window of a raster georeferenced by transform
+    covering (left, bottom, right, top) bounds
+    """
+    # a hair of tolerance so bounds on pixel edges do not grow a pixel
+    eps = 1e-6
+    xs, ys = zip(*[~transform * (x, y)
+                   for x in bounds[0::2] for y in bounds[1::2]])
+    return ((int(np.floor(min(ys) + eps)), int(np.ceil(max(ys) - eps))),
+            (int(np.floor(min(xs) + eps)), int(np.ceil(max(xs) - eps))))
+
+
+def _aligned(transform, other):
+    """Do two transforms share pixel size and orientation, with
+    pixel corners on each other?
+    """
+    if not np.allclose(
+            [transform.a, transform.b, transform.d, transform.e],
+            [other.a, other.b, other.d, other.e]):
+        return False
+    col, row = ~other * (transform.c, transform.f)
+    return np.allclose([col, row], [round(col), round(row)], atol=1e-6)
+
+
+def _boundless_slice(arr, window, fill=0):
+    """Slices a window from the last two axes of an array;
+    pixels outside the array are filled
+    """
+    out = np.full(
+        arr.shape[:-2] + (window[0][1] - window[0][0],
+                          window[1][1] - window[1][0]),
+        fill, dtype=arr.dtype)
+    rows = (max(window[0][0], 0), min(window[0][1], arr.shape[-2]))
+    cols = (max(window[1][0], 0), min(window[1][1], arr.shape[-1]))
+    if rows[0] < rows[1] and cols[0] < cols[1]:
+        out[...,
+            rows[0] - window[0][0]:rows[1] - window[0][0],
+            cols[0] - window[1][0]:cols[1] - window[1][0]] = arr[
+            ..., rows[0]:rows[1], cols[0]:cols[1]]
+
+    return out
+
+
+def _offset_window(window, offset):
+    """Shifts a window by (row, col) offset
+    """
+    return tuple(
+        (w[0] + o, w[1] + o) for w, o in zip(window, offset))
+
+
+def _bounding_window(windows):
+    """Computes the window covering all windows
+    """
+    return ((min(w[0][0] for w in windows), max(w[0][1] for w in windows)),
+            (min(w[1][0] for w in windows), max(w[1][1] for w in windows)))
+
+
+def _shard_windows(windows, shards):
+    """Splits windows into at most `shards` lists of whole,
+    non-overlapping bands of rows, so each shard covers a
+    rectangle no other shard touches
+    """
+    bands = []
+    for window, ij in sorted(windows, key=lambda w: w[0][0]):
+        if bands and window[0][0] < bands[-1][0][1]:
+            rows, members = bands[-1]
+            bands[-1] = ((rows[0], max(rows[1], window[0][1])),
+                         members + [(window, ij)])
+        else:
+            bands.append((window[0], [(window, ij)]))
+
+    shards = max(min(int(shards), len(bands)), 1)
+    size, extra = divmod(len(bands), shards)
+    sharded = []
+    start = 0
+    for i in range(shards):
+        stop = start + size + (1 if i < extra else 0)
+        sharded.append(
+            [w for _, members in bands[start:stop] for w in members])
+        start = stop
+
+    return [shard for shard in sharded if shard]
+
+
+def _band_weights(weight, count):
+    """Per-band weights of the synthetic pan band: a scalar
+    weight is the blue weight of 3 (red, green, blue) bands
+    """
+    if np.ndim(weight) == 0:
+        if count != 3:
+            raise RuntimeError(
+                "A weight per band is needed for {} color "
+                "bands".format(count))
+        return weight
+
+    if len(weight) != count:
+        raise RuntimeError(
+            "Received {} weights for {} color bands".format(
+                len(weight), count))
+
+    return tuple(float(w) for w in weight)
+
+
+def _shard_vrt(shards, profile, vrt_path=None):
+    """Builds a VRT document mosaicking shard GeoTIFFs, given
+    a list of (shard_path, shard_window) and the output profile;
+    shards are referenced relative to vrt_path's directory, or by
+    name when it is not given
+    """
+    dtypes = {'uint8': 'Byte', 'uint16': 'UInt16'}
+    colors = ['Red', 'Green', 'Blue', 'Alpha']
+    dtype = dtypes[np.dtype(profile['dtype']).name]
+
+    lines = [
+        '<VRTDataset rasterXSize="%d" rasterYSize="%d">' % (
+            profile['width'], profile['height']),
+        '  <SRS>%s</SRS>' % escape(profile['crs'].wkt),
+        '  <GeoTransform>%s</GeoTransform>' % ', '.join(
+            repr(float(v)) for v in profile['transform'].to_gdal())]
+    for bidx in range(1, profile['count'] + 1):
+        lines.append(
+            '  <VRTRasterBand dataType="%s" band="%d">' % (dtype, bidx))
+        if profile.get('photometric') == 'rgb':
+            lines.append(
+                '    <ColorInterp>%s</ColorInterp>' % colors[bidx - 1])
+        for path, window in shards:
+            height = window[0][1] - window[0][0]
+            width = window[1][1] - window[1][0]
+            lines.extend([
+                '    <SimpleSource>',
+                '      <SourceFilename relativeToVRT="1">%s'
+                '</SourceFilename>' % escape(
+                    os.path.relpath(path, os.path.dirname(
+                        os.path.abspath(vrt_path)))
+                    if vrt_path else os.path.basename(path)),
+                '      <SourceBand>%d</SourceBand>' % bidx,
+                '      <SrcRect xOff="0" yOff="0" '
+                'xSize="%d" ySize="%d"/>' % (width, height),
+                '      <DstRect xOff="%d" yOff="%d" '
+                'xSize="%d" ySize="%d"/>' % (
+                    window[1][0], window[0][0], width, height),
+                '    </SimpleSource>'])
+        lines.append('  </VRTRasterBand>')
+    lines.append('</VRTDataset>')
+
+    return '\n'.join(lines) + '\n'
+
+
+def _window_key(window):
+    """Serializable key identifying a window
+    """
+    return '%d:%d,%d:%d' % (
+        window[0][0], window[0][1], window[1][0], window[1][1])
+
+
+def _checksum(arrays):
+    """sha1 hex digest of the contents of a sequence of arrays
+    """
+    digest = hashlib.sha1()
+    for arr in arrays:
+        digest.update(np.ascontiguousarray(arr).tobytes())
+
+    return digest.hexdigest()
+
+
+def _intersecting_windows(windows, bounds_window):
+    """Keeps the windows that intersect bounds_window
+    """
+    return [
+        (window, ij) for window, ij in windows
+        if all(w[0] < b[1] and b[0] < w[1]
+               for w, b in zip(window, bounds_window))]
+
+
+def _split_window(window):
+    """Splits a window into quarters
+    """
+    (r0, r1), (c0, c1) = window
+    rm = (r0 + r1) // 2
+    cm = (c0 + c1) // 2
+    return [((r0, rm), (c0, cm)), ((r0, rm), (cm, c1)),
+            ((rm, r1), (c0, cm)), ((rm, r1), (cm, c1))]
+
+
+def _window_cost(window, valid, shape):
+    """Estimates the cost of a window as its area weighted by the
+    fraction of valid pixels in it, from a (possibly decimated)
+    boolean array of valid pixels over a raster of `shape`
+    """
+    rows = [int(w * valid.shape[0] / shape[0]) for w in window[0]]
+    cols = [int(w * valid.shape[1] / shape[1]) for w in window[1]]
+    sample = valid[rows[0]:max(rows[1], rows[0] + 1),
+                   cols[0]:max(cols[1], cols[0] + 1)]
+    fraction = sample.mean() if sample.size else 0.0
+    area = (window[0][1] - window[0][0]) * (window[1][1] - window[1][0])
+
+    # mostly empty windows still pay for their reads
+    return area * (0.1 + 0.9 * fraction)
+
+
+def _balance_windows(windows, valid, shape, jobs, minsize=256):
+    """Splits windows estimated to cost more than a quarter of one
+    worker's share of the run, then orders them largest cost first,
+    so no late straggler keeps the other workers idle at the end.
+    A single worker has nobody to wait on, so nothing is split.
+    """
+    costed = [(_window_cost(window, valid, shape), window, ij)
+              for window, ij in windows]
+    share = sum(cost for cost, _, _ in costed) / (4.0 * max(int(jobs), 1))
+
+    balanced = []
+    while costed:
+        cost, window, ij = costed.pop()
+        if jobs > 1 and cost > share and \
+                min(w[1] - w[0] for w in window) >= 2 * minsize:
+            costed.extend(
+                (_window_cost(part, valid, shape), part, ij)
+                for part in _split_window(window))
+        else:
+            balanced.append((cost, window, ij))
+
+    balanced.sort(key=lambda c: (-c[0], c[1]))
+
+    return [(window, ij) for _, window, ij in balanced]
+
+
+def _window_bytes(window, bands, dst_dtype):
+    """Estimates the bytes a window holds while in flight: float32
+    pan, upsampled and sharpened bands, plus the output with alpha
+    """
+    pixels = (window[0][1] - window[0][0]) * (window[1][1] - window[1][0])
+    return pixels * (4 + 8 * bands +
+                     (bands + 1) * np.dtype(dst_dtype).itemsize)
+
+
+def _fit_windows(windows, limit, nbytes, minsize=64):
+    """Splits windows until each is estimated to need at most limit
+    bytes, or is too small to split
+    """
+    fitted = []
+    pending = list(reversed(windows))
+    while pending:
+        window, ij = pending.pop()
+        if nbytes(window) > limit and \
+                min(w[1] - w[0] for w in window) >= 2 * minsize:
+            pending.extend(
+                (part, ij) for part in reversed(_split_window(window)))
+        else:
+            fitted.append((window, ij))
+
+    return fitted
+
+
+class _MemoryBudget(object):
+    """Blocks acquire() while the bytes in flight would exceed the
+    budget; a request larger than the budget waits for an empty one.
+    abort() wakes every waiter and makes acquire() return False
+    """
+    def __init__(self, budget):
+        self.budget = budget
+        self.in_flight = 0
+        self.aborted = False
+        self._cond = threading.Condition()
+
+    def acquire(self, nbytes):
+        with self._cond:
+            while not self.aborted and self.in_flight and \
+                    self.in_flight + nbytes > self.budget:
+                self._cond.wait()
+            if self.aborted:
+                return False
+            self.in_flight += nbytes
+            return True
+
+    def release(self, nbytes):
+        with self._cond:
+            self.in_flight -= nbytes
+            self._cond.notify_all()
+
+    def abort(self):
+        with self._cond:
+            self.aborted = True
+            self._cond.notify_all()
+
+
+def _peak_rss():
+    """Peak resident set size of this process, in bytes,
+    or None where the resource module is unavailable
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _peak_rss_report(peaks):
+    """Formats peak resident set size, in bytes, per process
+    """
+    return ['process %s: peak RSS %.1f MB' % (pid, rss / 2.0 ** 20)
+            for pid, rss in sorted(peaks.items()) if rss is not None]
+
+
+def _utilization_report(busy, wall):
+    """Formats busy seconds per worker process as utilization
+    of the wall clock time of a run
+    """
+    return ['worker %s: busy %.2fs of %.2fs (%.0f%%)' % (
+        pid, seconds, wall, 100.0 * seconds / wall if wall else 0.0)
+        for pid, seconds in sorted(busy.items())]
+
+
+def _compression_threads(profile, jobs):
+    """Enable GDAL's multithreaded encoder when the output
+    is compressed, unless num_threads was set explicitly
+    """
+    compress = profile.get('compress')
+    if compress and str(compress).lower() != 'none' and \
+            'num_threads' not in profile:
+        profile['num_threads'] = max(int(jobs), 1)
+
+    return profile
+
+
+def _shard_profile(profile):
+    """Write profile of a shard: shards are written by many
+    processes at once, so each encodes on a single thread
+    """
+    profile = profile.copy()
+    if 'num_threads' in profile:
+        profile['num_threads'] = 1
+
+    return profile
+
+
 def _rescale(arr, ndv, dst_dtype, out_alpha=True):
     """Convert an array from output dtype, scaling up linearly
     """
@@ -149,8 +659,66 @@ def _rescale(arr, ndv, dst_dtype, out_alpha=True):
     if out_alpha:
         mask = _simple_mask(
             arr.astype(dst_dtype),
-            (ndv, ndv, ndv)).reshape(
+            (ndv,) * arr.shape[0]).reshape(
                 1, arr.shape[1], arr.shape[2])
         return np.concatenate([res, mask])
     else:
         return res
+
+
+def _output_backend(dst_path):
+    """Output backend for dst_path: 'zarr' for a .zarr directory
+    store, otherwise 'gtiff'
+    """
+    path = dst_path.rstrip('/\\')
+    return 'zarr' if path.lower().endswith('.zarr') else 'gtiff'
+
+
+def _mosaic_grid(footprints, transform):
+    """Smallest grid aligned with transform covering all footprints,
+    (left, bottom, right, top) in the CRS of transform
+
+    Returns
+    ---------
+    out: tuple
+        (transform, width, height)
+    """
+    windows = [_bounds_window(bounds, transform) for bounds in footprints]
+    row_start = min(w[0][0] for w in windows)
+    col_start = min(w[1][0] for w in windows)
+    return (transform * Affine.translation(col_start, row_start),
+            max(w[1][1] for w in windows) - col_start,
+            max(w[0][1] for w in windows) - row_start)
+
+
+def _footprint_index(footprints, transform, shape, blocksize):
+    """Indexes scene footprints by the blocks of a (height, width)
+    grid they intersect, so each output window reads only the
+    scenes that can cover it
+
+    Returns
+    ---------
+    out: dict
+        (block row, block col) to scene numbers, in scene order
+    """
+    index = {}
+    for n, bounds in enumerate(footprints):
+        (r0, r1), (c0, c1) = _bounds_window(bounds, transform)
+        r0, r1 = max(r0, 0), min(r1, shape[0])
+        c0, c1 = max(c0, 0), min(c1, shape[1])
+        if r0 >= r1 or c0 >= c1:
+            continue
+        for i in range(r0 // blocksize, (r1 - 1) // blocksize + 1):
+            for j in range(c0 // blocksize, (c1 - 1) // blocksize + 1):
+                index.setdefault((i, j), []).append(n)
+
+    return index
+
+
+def _fill_invalid(mosaic, layer):
+    """Copies the pixels of layer, alpha last, into the pixels of
+    mosaic its alpha marks as invalid; first valid pixel wins
+    """
+    fill = (mosaic[-1] == 0) & (layer[-1] != 0)
+    mosaic[:, fill] = layer[:, fill]
+    return mosaic
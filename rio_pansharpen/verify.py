@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+"""Per-window checksums and comparisons of pansharpened outputs.
+
+Windows come from a fixed grid over the output rather than the
+processing windows, so manifests of runs with different --jobs,
+window sizes or execution backends can be compared directly.
+"""
+from __future__ import division
+
+import json
+
+import numpy as np
+import rasterio
+
+from .utils import _make_windows, _window_key, _checksum
+
+
+def _grid(src, blocksize):
+    return _make_windows(src.width, src.height, blocksize)
+
+
+def checksums_path(dst_path):
+    """Path of the sidecar manifest of per-window output checksums
+    """
+    return '%s.checksums.json' % dst_path
+
+
+def output_checksums(path, blocksize=512):
+    """Checksums each window of a fixed grid over a raster
+
+    Returns
+    ---------
+    out: dict
+        window key to sha1 of the window's pixels, all bands
+    """
+    with rasterio.open(path) as src:
+        return dict(
+            (_window_key(window), _checksum([src.read(window=window)]))
+            for window in _grid(src, blocksize))
+
+
+def write_checksums(path, manifest_path=None, blocksize=512):
+    """Writes the per-window checksums of a raster to a JSON manifest,
+    by default next to it
+    """
+    manifest_path = manifest_path or checksums_path(path)
+    with open(manifest_path, 'w') as f:
+        json.dump({'blocksize': blocksize,
+                   'windows': output_checksums(path, blocksize)},
+                  f, indent=0, sort_keys=True)
+
+    return manifest_path
+
+
+def compare_checksums(manifest_path, other_manifest_path):
+    """Lists the window keys whose checksums differ between manifests
+    """
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    with open(other_manifest_path) as f:
+        other = json.load(f)
+
+    if manifest['blocksize'] != other['blocksize']:
+        raise RuntimeError(
+            "Manifests use different grids: {} and {}".format(
+                manifest['blocksize'], other['blocksize']))
+
+    keys = set(manifest['windows']) | set(other['windows'])
+    return sorted(
+        key for key in keys
+        if manifest['windows'].get(key) != other['windows'].get(key))
+
+
+def compare_outputs(path, other_path, blocksize=512):
+    """Compares two rasters of the same shape window by window,
+    e.g. a fast kernel's output against the reference Brovey
+
+    Returns
+    ---------
+    out: dict
+        window key to the max absolute difference in the window
+    """
+    with rasterio.open(path) as src, rasterio.open(other_path) as other:
+        if (src.count, src.height, src.width) != \
+                (other.count, other.height, other.width):
+            raise RuntimeError(
+                "Cannot compare {} and {}: shapes differ".format(
+                    path, other_path))
+
+        return dict(
+            (_window_key(window), int(np.abs(
+                src.read(window=window).astype(np.int64) -
+                other.read(window=window).astype(np.int64)).max()))
+            for window in _grid(src, blocksize))
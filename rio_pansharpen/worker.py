@@ -1,16 +1,44 @@
 #!/usr/bin/env python
 from __future__ import division
 
+import json
+import os
+import time
+import uuid
+
 import click
 import numpy as np
 import rasterio
 import riomucho
-from rio_pansharpen.methods import Brovey
+from rio_pansharpen.methods import Brovey, BroveyUint8
+from rio_pansharpen.prefetch import prefetch as _prefetch_windows
+from rio_pansharpen.verify import write_checksums
+from affine import Affine
+from rasterio.enums import Resampling
 from rasterio.transform import guard_transform
+from rasterio.warp import reproject, transform_bounds
 
 from . utils import (
     _pad_window, _upsample, _calc_windows, _check_crs,
-    _create_apply_mask, _half_window, _rescale)
+    _create_apply_mask, _half_window, _rescale, _compression_threads,
+    _BlockCache, _read_cached, _group_windows, _cache_tile_shape,
+    _offset_window, _bounding_window, _shard_windows, _shard_vrt,
+    _window_key, _checksum, _intersecting_windows, _band_weights,
+    _balance_windows, _utilization_report, _make_windows,
+    _transform_window, _boundless_slice, _adjust_block_size,
+    _window_bytes, _fit_windows, _MemoryBudget, _peak_rss, _peak_rss_report,
+    _output_backend, _shard_profile, _bounds_window, _aligned, _mosaic_grid,
+    _footprint_index, _fill_invalid)
+
+# decoded rgb tiles, shared by the windows a worker process handles
+_rgb_cache = _BlockCache(maxsize=64, maxbytes=64 * 2 ** 20)
+
+# inputs and arguments of a memory-bounded worker process
+_bounded_files = None
+_bounded_args = None
+
+# output array of a Zarr worker process
+_zarr_dst = None
 
 
 def pansharpen(vis, vis_transform, pan, pan_transform,
@@ -20,20 +48,22 @@ def pansharpen(vis, vis_transform, pan, pan_transform,
 
     Parameters
     =========
-    vis: ndarray, 3D with shape == (3, vh, vw)
-        Visual band array with RGB bands
+    vis: ndarray, 3D with shape == (n, vh, vw)
+        Visual band array with RGB (or any n) bands
     vis_transform: Affine
         affine transform defining the georeferencing of the vis array
     pan: ndarray, 2D with shape == (ph, pw)
         Panchromatic band array
     pan_transform: Affine
         affine transform defining the georeferencing of the pan array
+    weight: float or sequence of float
+        blue weight of RGB bands, or one weight per band
     method: string
         Algorithm for pansharpening; default Brovey
 
     Returns:
     ======
-    pansharp: ndarray, 3D with shape == (3, ph, pw)
+    pansharp: ndarray, 3D with shape == (n, ph, pw)
         pansharpened visual band
         affine transform is identical to `pan_transform`
     """
@@ -48,24 +78,123 @@ def pansharpen(vis, vis_transform, pan, pan_transform,
     return pansharp
 
 
-def _pansharpen_worker(open_files, pan_window, _, g_args):
-    """rio mucho worker for pansharpening. It reads input
-    files and performing pansharpening on each window.
+def _pansharpen_rescaled(vis, vis_transform, pan, pan_transform,
+                         pan_dtype, r_crs, dst_crs, weight, dst_dtype,
+                         out_alpha, method="Brovey", src_nodata=0):
+    """pansharpen followed by _rescale. 16 bit inputs go straight
+    to 8 bit output, skipping the 16 bit intermediate array
+    """
+    if method == "Brovey" and dst_dtype == np.uint8 and \
+            np.dtype(pan_dtype) == np.uint16 and src_nodata == 0:
+        rgb = _upsample(_create_apply_mask(vis), pan.shape, vis_transform,
+                        r_crs, pan_transform, dst_crs)
+        out = np.empty(
+            (rgb.shape[0] + (1 if out_alpha else 0),) + pan.shape,
+            dtype=np.uint8)
+        _, valid = BroveyUint8(rgb, pan, weight, out=out[:rgb.shape[0]])
+        if out_alpha:
+            out[-1] = valid
+            out[-1] *= np.iinfo(np.uint8).max
+        return out
+
+    return _rescale(
+        pansharpen(vis, vis_transform, pan, pan_transform, pan_dtype,
+                   r_crs, dst_crs, weight, method=method,
+                   src_nodata=src_nodata),
+        src_nodata, dst_dtype, out_alpha=out_alpha)
+
+
+def pansharpen_blocks(blocks, weight, crs='EPSG:3857', dst_dtype='uint8',
+                      out_alpha=True, method="Brovey", src_nodata=0):
+    """Pansharpen in-memory blocks, without touching the disk
 
     Parameters
-    ------------
-    open_files: list of rasterio open files
-    pan_window: tuples
-    g_args: dictionary
+    =========
+    blocks: iterable of tuples
+        (pan, vis, pan_transform, vis_transform), arrays and transforms
+        as taken by `pansharpen`; vis should cover pan with a small
+        margin so the bilinear upsample has neighbors at the edges
+    weight: float or sequence of float
+        blue weight of RGB bands, or one weight per band
+    crs: CRS or string
+        CRS of both arrays; only their transforms matter for the
+        upsample, so any CRS works for ungeoreferenced pixels
+    dst_dtype: 'uint16', 'uint8'
+    out_alpha: boolean
+        append an alpha band?
+
+    Yields
+    ======
+    pansharp: ndarray, 3D with shape == (n (+1 alpha), ph, pw)
+        pansharpened block, rescaled to dst_dtype
+    """
+    dst_dtype = np.dtype(dst_dtype).type
+    for pan, vis, pan_transform, vis_transform in blocks:
+        yield _pansharpen_rescaled(
+            vis.astype(np.float32), vis_transform,
+            pan.astype(np.float32), pan_transform,
+            pan.dtype, crs, crs, weight, dst_dtype, out_alpha,
+            method=method, src_nodata=src_nodata)
+
+
+def pansharpen_array(pan, pan_transform, vis, vis_transform, weight,
+                     crs='EPSG:3857', dst_dtype='uint8', out_alpha=True,
+                     blocksize=512, method="Brovey", src_nodata=0):
+    """Pansharpen whole in-memory arrays window by window, with the
+    same windowing, padding and masking as calculate_landsat_pansharpen
+
+    Parameters
+    =========
+    pan: ndarray, 2D with shape == (ph, pw)
+    pan_transform: Affine
+    vis: ndarray, 3D with shape == (n, vh, vw)
+    vis_transform: Affine
+    weight: float or sequence of float
+    crs: CRS or string
+        CRS of both arrays
+    blocksize: integer
+        size of the processing windows
 
     Returns
-    ---------
-    out: None
-        Output is written to dst_path
+    ======
+    pansharp: ndarray, 3D with shape == (n (+1 alpha), ph, pw)
+    """
+    height, width = pan.shape
+    windows = list(_make_windows(
+        width, height, _adjust_block_size(width, height, blocksize)))
 
+    def blocks():
+        for window in windows:
+            vis_window = _pad_window(
+                _transform_window(window, pan_transform, vis_transform), 2)
+            yield (
+                pan[window[0][0]:window[0][1], window[1][0]:window[1][1]],
+                _boundless_slice(vis, vis_window),
+                pan_transform * Affine.translation(
+                    window[1][0], window[0][0]),
+                vis_transform * Affine.translation(
+                    vis_window[1][0], vis_window[0][0]))
+
+    out = np.empty(
+        (vis.shape[0] + (1 if out_alpha else 0), height, width),
+        dtype=np.dtype(dst_dtype))
+    for window, block in zip(windows, pansharpen_blocks(
+            blocks(), weight, crs, dst_dtype, out_alpha, method,
+            src_nodata)):
+        out[:, window[0][0]:window[0][1], window[1][0]:window[1][1]] = block
+
+    return out
+
+
+def _read_inputs(open_files, pan_window, g_args):
+    """Reads the pan window and the rgb window covering it
+
+    Returns
+    ---------
+    out: tuple
+        pan array, rgb array and their affine transforms
     """
     pan = open_files[0].read(1, window=pan_window).astype(np.float32)
-    pan_dtype = open_files[0].meta['dtype']
 
     # Get the rgb window that covers the pan window
     if g_args.get("half_window"):
@@ -73,41 +202,586 @@ def _pansharpen_worker(open_files, pan_window, _, g_args):
     else:
         padding = 2
         pan_bounds = open_files[0].window_bounds(pan_window)
-        rgb_base_window = open_files[1].window(*pan_bounds)
+        rgb_base_window = _bounds_window(
+            pan_bounds, guard_transform(open_files[1].transform))
         rgb_window = _pad_window(rgb_base_window, padding)
 
     # Determine affines for those windows
     pan_affine = open_files[0].window_transform(pan_window)
     rgb_affine = open_files[1].window_transform(rgb_window)
 
-    rgb = riomucho.utils.array_stack(
-        [src.read(window=rgb_window, boundless=True).astype(np.float32)
-         for src in open_files[1:]])
+    # color band indexes to read from each color file
+    indexes = g_args.get("indexes") or [src.indexes for src in open_files[1:]]
+
+    if g_args.get("half_window"):
+        rgb = riomucho.utils.array_stack(
+            [src.read(list(idx), window=rgb_window,
+                      boundless=True).astype(np.float32)
+             for src, idx in zip(open_files[1:], indexes)])
+    else:
+        # assemble the padded window from cached rgb tiles so the halo
+        # and tiles shared with neighboring windows are decoded once;
+        # all bands of a multiband file come from one read per tile
+        rgb = np.empty(
+            (sum(len(idx) for idx in indexes),
+             rgb_window[0][1] - rgb_window[0][0],
+             rgb_window[1][1] - rgb_window[1][0]), dtype=np.float32)
+        start = 0
+        for src, idx in zip(open_files[1:], indexes):
+            _read_cached(src, idx, rgb_window, _rgb_cache,
+                         out=rgb[start:start + len(idx)])
+            start += len(idx)
+
+    return pan, rgb, pan_affine, rgb_affine
+
+
+def _pansharpen_worker(open_files, pan_window, _, g_args):
+    """rio mucho worker for pansharpening. It reads input
+    files and performing pansharpening on each window.
+
+    Parameters
+    ------------
+    open_files: list of rasterio open files
+    pan_window: tuples
+    g_args: dictionary
+
+    Returns
+    ---------
+    out: None
+        Output is written to dst_path
+
+    """
+    start = time.time()
+    out = _sharpen_inputs(
+        _read_inputs(open_files, pan_window, g_args),
+        open_files[0].meta['dtype'], g_args)
+
+    # busy seconds per worker process, for the utilization report
+    busy = g_args.get("busy")
+    if busy is not None:
+        pid = os.getpid()
+        busy[pid] = busy.get(pid, 0.0) + time.time() - start
+
+    return out
+
+
+def _sharpen_inputs(inputs, pan_dtype, g_args):
+    """Pansharpens and rescales the arrays read by _read_inputs
+    """
+    pan, rgb, pan_affine, rgb_affine = inputs
 
     if g_args["verb"]:
         click.echo('pan shape: %s, rgb shape %s' % (pan.shape, rgb.shape))
 
-    pansharpened = pansharpen(
+    return _pansharpen_rescaled(
         rgb, rgb_affine, pan, pan_affine, pan_dtype,
-        g_args["r_crs"], g_args["dst_crs"],
-        g_args["weight"], method="Brovey")
+        g_args["r_crs"], g_args["dst_crs"], g_args["weight"],
+        g_args["dst_dtype"], g_args.get("out_alpha", True),
+        method="Brovey", src_nodata=g_args["src_nodata"])
+
+
+def _input_checksums(src_paths, windows, g_args):
+    """Checksums the inputs each window is computed from
+
+    Returns
+    ---------
+    out: dict
+        window key to checksum of the pan and padded rgb windows
+    """
+    open_files = [rasterio.open(path) for path in src_paths]
+    try:
+        return dict(
+            (_window_key(window),
+             _checksum(_read_inputs(open_files, window, g_args)[:2]))
+            for window, _ in windows)
+    finally:
+        for src in open_files:
+            src.close()
+
+
+def _run_shard(src_paths, shard_path, windows, g_args, profile):
+    """Pansharpens a shard of windows into its own GeoTIFF.
+    Runs wherever the executor places it, so it opens its own inputs.
+
+    Returns
+    ---------
+    out: tuple
+        shard path and the window it covers in the output
+    """
+    shard_window = _bounding_window([window for window, _ in windows])
+    origin = (shard_window[0][0], shard_window[1][0])
+
+    shard_profile = profile.copy()
+    shard_profile.update(
+        height=shard_window[0][1] - shard_window[0][0],
+        width=shard_window[1][1] - shard_window[1][0],
+        transform=guard_transform(profile['transform']) * Affine.translation(
+            origin[1], origin[0]))
+
+    _rgb_cache.clear()
+    with rasterio.open(src_paths[0]) as pan_src:
+        pan_dtype = pan_src.meta['dtype']
+
+    def read(open_files, window):
+        return _read_inputs(open_files, window[0], g_args)
+
+    # reads of the next windows overlap with compute on this one
+    with rasterio.open(shard_path, 'w', **shard_profile) as dst:
+        for (window, _), inputs in _prefetch_windows(
+                src_paths, read, windows,
+                depth=g_args.get("prefetch") or 1,
+                concurrency=g_args.get("prefetch") or 1):
+            dst.write(
+                _sharpen_inputs(inputs, pan_dtype, g_args),
+                window=_offset_window(window, (-origin[0], -origin[1])))
+
+    return shard_path, shard_window
+
+
+def _run_sharded(src_paths, dst_path, windows, g_args, profile,
+                 shards, executor, mode='w', shard_dir=None):
+    """Dispatches window shards through an executor and copies
+    the shard outputs into dst_path, opened with `mode`; a .vrt
+    dst_path references the shards in place instead. Shards are
+    written to shard_dir, by default next to dst_path
+    """
+    base, ext = os.path.splitext(os.path.basename(dst_path))
+    shard_dir = shard_dir or os.path.dirname(os.path.abspath(dst_path))
+    sharded = _shard_windows(windows, shards)
+    # a token per run keeps the shards of other runs, such as those
+    # an existing VRT references, from being overwritten
+    token = uuid.uuid4().hex[:8]
+    shard_paths = [
+        os.path.join(shard_dir, '%s.%s.shard%04d.tif' % (base, token, i))
+        for i in range(len(sharded))]
+    # the copy into dst_path below keeps the profile's encoder threads
+    shard_profile = _shard_profile(profile)
+    referenced = False
+    try:
+        futures = [
+            executor.submit(
+                _run_shard, src_paths, shard_path, shard, g_args,
+                shard_profile)
+            for shard_path, shard in zip(shard_paths, sharded)]
+        results = [future.result() for future in futures]
+
+        if mode == 'w' and ext.lower() == '.vrt':
+            with open(dst_path, 'w') as vrt:
+                vrt.write(_shard_vrt(results, profile, dst_path))
+            referenced = True
+            return
+
+        if mode == 'w':
+            dst = rasterio.open(dst_path, 'w', **profile)
+        else:
+            dst = rasterio.open(dst_path, mode)
+
+        with dst:
+            for (shard_path, shard_window), shard in zip(results, sharded):
+                origin = (-shard_window[0][0], -shard_window[1][0])
+                with rasterio.open(shard_path) as src:
+                    for window, _ in shard:
+                        dst.write(
+                            src.read(window=_offset_window(window, origin)),
+                            window=window)
+    finally:
+        # failed runs leave no partial shards behind
+        if not referenced:
+            for shard_path in shard_paths:
+                if os.path.exists(shard_path):
+                    os.remove(shard_path)
+
+
+def _init_bounded(src_paths, g_args):
+    """Opens the inputs of a memory-bounded worker process
+    """
+    global _bounded_files, _bounded_args
+    _bounded_files = [rasterio.open(path) for path in src_paths]
+    _bounded_args = g_args
+
+
+def _bounded_worker(task):
+    """Pansharpens one window in a memory-bounded worker process,
+    returning the result with the process' busy time and peak RSS
+    """
+    window, ij = task
+    start = time.time()
+    data = _pansharpen_worker(_bounded_files, window, ij, _bounded_args)
+    return data, window, os.getpid(), time.time() - start, _peak_rss()
+
+
+def _run_bounded(src_paths, dst_path, windows, g_args, profile, jobs,
+                 max_memory, report_busy):
+    """Runs the windows on `jobs` processes, holding back new windows
+    while the estimated bytes of windows being computed or waiting
+    for the writer exceed max_memory, then reports peak RSS per process
+    """
+    bands = profile['count'] - (1 if g_args["out_alpha"] else 0)
+
+    def nbytes(window):
+        return _window_bytes(window, bands, profile['dtype'])
+
+    # leave room for a window per worker plus one waiting per worker
+    windows = _fit_windows(windows, max_memory / (2.0 * jobs), nbytes)
+    budget = _MemoryBudget(max_memory)
+
+    def tasks():
+        # pulled by the pool's task feeder thread, so blocking here
+        # throttles reads without stalling the writer
+        for window, ij in windows:
+            if not budget.acquire(nbytes(window)):
+                return
+            yield window, ij
+
+    pool = None
+    if jobs > 1:
+        from multiprocessing import Pool
+        pool = Pool(jobs, _init_bounded, (src_paths, g_args))
+        results = pool.imap_unordered(_bounded_worker, tasks())
+    else:
+        _init_bounded(src_paths, g_args)
+        results = (_bounded_worker(task) for task in tasks())
+
+    busy, peaks = {}, {}
+    start = time.time()
+    try:
+        with rasterio.open(dst_path, 'w', **profile) as dst:
+            for data, window, pid, seconds, rss in results:
+                dst.write(data, window=window)
+                budget.release(nbytes(window))
+                busy[pid] = busy.get(pid, 0.0) + seconds
+                peaks[pid] = max(peaks.get(pid) or 0, rss or 0) or None
+    except BaseException:
+        # the task feeder may be blocked on the budget, which nothing
+        # releases any more; wake it before tearing the pool down
+        budget.abort()
+        if pool is not None:
+            pool.terminate()
+        raise
+    else:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    finally:
+        if pool is None:
+            for src in _bounded_files:
+                src.close()
+
+    peaks[os.getpid()] = max(peaks.get(os.getpid()) or 0, _peak_rss() or 0)
+    lines = _peak_rss_report(peaks)
+    if report_busy:
+        lines += _utilization_report(busy, time.time() - start)
+    for line in lines:
+        click.echo(line)
+
+
+def _init_zarr(src_paths, g_args, dst_path):
+    """Opens the inputs and the output array of a Zarr worker process
+    """
+    global _zarr_dst
+    from rio_pansharpen.zarr_store import open_zarr
+    _init_bounded(src_paths, g_args)
+    _zarr_dst = open_zarr(dst_path, mode='r+')[0]
+
+
+def _zarr_worker(task):
+    """Pansharpens one window and writes it to its own chunk
+    """
+    window, ij = task
+    data = _pansharpen_worker(_bounded_files, window, ij, _bounded_args)
+    (row_start, row_stop), (col_start, col_stop) = window
+    _zarr_dst[:, row_start:row_stop, col_start:col_stop] = data
+    return window
+
+
+def _run_zarr(src_paths, dst_path, windows, g_args, profile, jobs):
+    """Creates a Zarr array chunked like the windows, then has `jobs`
+    processes write their chunks directly, with no single writer
+    """
+    from rio_pansharpen.zarr_store import (
+        create_zarr, _zarr_chunks, _check_chunks)
+    chunks = _zarr_chunks(windows)
+    # two windows writing parts of one chunk would race
+    _check_chunks(windows, chunks)
+    create_zarr(dst_path, profile, chunks, alpha=g_args["out_alpha"])
+
+    if jobs > 1:
+        from multiprocessing import Pool
+        pool = Pool(jobs, _init_zarr, (src_paths, g_args, dst_path))
+        try:
+            for _ in pool.imap_unordered(_zarr_worker, windows):
+                pass
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        _init_zarr(src_paths, g_args, dst_path)
+        try:
+            for task in windows:
+                _zarr_worker(task)
+        finally:
+            for src in _bounded_files:
+                src.close()
+
+
+def _inputs_manifest(dst_path):
+    """Path of the sidecar holding per-window input checksums
+    """
+    return '%s.inputs.json' % dst_path
+
+
+def _update_output(src_paths, dst_path, windows, g_args, profile,
+                   jobs, shards, executor, bounds_window, shard_dir=None):
+    """Recomputes, in place, the windows of an existing output that
+    intersect bounds_window or whose inputs no longer match the
+    stored checksums, then rebuilds the output overviews
+    """
+    if os.path.splitext(dst_path)[1].lower() == '.vrt':
+        raise RuntimeError(
+            "Cannot update {}: a VRT references its shards, which an "
+            "update would overwrite; rerun it instead".format(dst_path))
+
+    if not os.path.exists(dst_path):
+        raise RuntimeError(
+            "Cannot update {}: it does not exist".format(dst_path))
+
+    with rasterio.open(dst_path) as dst:
+        if (dst.width, dst.height, dst.count) != (
+                profile['width'], profile['height'], profile['count']):
+            raise RuntimeError(
+                "Cannot update {}: its shape does not match the "
+                "inputs".format(dst_path))
 
-    pan_rescale = _rescale(
-        pansharpened, g_args["src_nodata"], g_args["dst_dtype"],
-        out_alpha=g_args.get("out_alpha", True))
+    manifest_path = _inputs_manifest(dst_path)
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            stored = json.load(f)['windows']
+    elif bounds_window is None:
+        raise RuntimeError(
+            "No stored input checksums for {}: pass bounds or record "
+            "them with a full run".format(dst_path))
+    else:
+        stored = None
+
+    if bounds_window is not None:
+        windows = _intersecting_windows(windows, bounds_window)
+        checksums = {}
+        if stored is not None:
+            checksums = _input_checksums(src_paths, windows, g_args)
+    else:
+        checksums = _input_checksums(src_paths, windows, g_args)
+        windows = [
+            (window, ij) for window, ij in windows
+            if stored.get(_window_key(window)) !=
+            checksums[_window_key(window)]]
+
+    if g_args["verb"]:
+        click.echo('updating %d windows' % len(windows))
+
+    if not windows:
+        return
+
+    if executor is not None:
+        _run_sharded(src_paths, dst_path, windows, g_args, profile,
+                     max(shards, jobs), executor, mode='r+',
+                     shard_dir=shard_dir)
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            _run_sharded(src_paths, dst_path, windows, g_args, profile,
+                         max(shards, jobs), pool, mode='r+',
+                         shard_dir=shard_dir)
 
-    return pan_rescale
+    if stored is not None:
+        stored.update(checksums)
+        with open(manifest_path, 'w') as f:
+            json.dump({'windows': stored}, f)
+
+    with rasterio.open(dst_path, 'r+') as dst:
+        factors = dst.overviews(1)
+        if factors:
+            resampling = dst.tags(ns='rio_overview').get(
+                'resampling', 'nearest')
+            dst.build_overviews(factors, Resampling[resampling])
+
+
+class _UnsupportedOptions(RuntimeError):
+    """Options the selected runner does not support"""
+    def __init__(self, runner, options):
+        RuntimeError.__init__(self, "{} not supported by {}".format(
+            ', '.join(options), runner.name))
+        self.runner = runner
+        self.options = options
+
+
+class _Runner(object):
+    """A way of running the windows of a scene
+
+    Parameters
+    ------------
+    name: string
+        used in error messages
+    backend: 'gtiff' or 'zarr'
+        output format the runner writes
+    selects: tuple of string
+        options selecting the runner; none for a default
+    supports: tuple of string
+        options the runner honors
+    run: callable
+        run(src_paths, dst_path, windows, g_args, profile, jobs, options)
+    """
+    def __init__(self, name, backend, selects, supports, run):
+        self.name = name
+        self.backend = backend
+        self.selects = frozenset(selects)
+        self.supports = frozenset(supports)
+        self.run = run
+
+
+def _run_zarr_runner(src_paths, dst_path, windows, g_args, profile, jobs,
+                     options):
+    _run_zarr(src_paths, dst_path, windows, g_args, profile, jobs)
+
+
+def _run_update_runner(src_paths, dst_path, windows, g_args, profile,
+                       jobs, options):
+    _update_output(src_paths, dst_path, windows, g_args, profile, jobs,
+                   options['shards'], options['executor'],
+                   options['bounds_window'], options['shard_dir'])
+
+
+def _run_sharded_runner(src_paths, dst_path, windows, g_args, profile,
+                        jobs, options):
+    if options['executor'] is not None:
+        _run_sharded(src_paths, dst_path, windows, g_args, profile,
+                     options['shards'], options['executor'],
+                     shard_dir=options['shard_dir'])
+        return
+
+    # riomucho workers get one window at a time, so reading
+    # ahead needs the shard runner
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        _run_sharded(src_paths, dst_path, windows, g_args, profile,
+                     max(options['shards'], jobs), pool,
+                     shard_dir=options['shard_dir'])
+
+
+def _run_bounded_runner(src_paths, dst_path, windows, g_args, profile,
+                        jobs, options):
+    _run_bounded(src_paths, dst_path, windows, g_args, profile, jobs,
+                 options['max_memory'], options['balance'])
+
+
+def _run_balanced_runner(src_paths, dst_path, windows, g_args, profile,
+                         jobs, options):
+    from multiprocessing import Manager
+    with Manager() as manager:
+        g_args["busy"] = manager.dict()
+        start = time.time()
+        _run_riomucho_runner(src_paths, dst_path, windows, g_args, profile,
+                             jobs, options)
+        for line in _utilization_report(
+                dict(g_args.pop("busy")), time.time() - start):
+            click.echo(line)
+
+
+def _run_riomucho_runner(src_paths, dst_path, windows, g_args, profile,
+                         jobs, options):
+    with riomucho.RioMucho(src_paths, dst_path, _pansharpen_worker,
+                           windows=windows, global_args=g_args,
+                           options=profile, mode='manual_read') as rm:
+        rm.run(jobs)
+
+
+# options any scene runner honors, being handled around the run
+_SCENE_OPTIONS = ('half_window', 'color_bands', 'record_inputs')
+
+# in order of precedence: the first runner of the backend selected by
+# a requested option, or its default, runs the scene
+_RUNNERS = (
+    _Runner('Zarr output', 'zarr', (), _SCENE_OPTIONS, _run_zarr_runner),
+    _Runner('updates', 'gtiff', ('update',), _SCENE_OPTIONS + (
+        'update', 'bounds', 'shards', 'executor', 'shard_dir',
+        'checksums'), _run_update_runner),
+    _Runner('sharded runs', 'gtiff', ('shards', 'executor', 'prefetch'),
+            _SCENE_OPTIONS + ('shards', 'executor', 'prefetch', 'shard_dir',
+                              'checksums'), _run_sharded_runner),
+    _Runner('memory-bounded runs', 'gtiff', ('max_memory',),
+            _SCENE_OPTIONS + ('max_memory', 'balance', 'checksums'),
+            _run_bounded_runner),
+    _Runner('balanced runs', 'gtiff', ('balance',),
+            _SCENE_OPTIONS + ('balance', 'checksums'), _run_balanced_runner),
+    _Runner('single-writer runs', 'gtiff', (),
+            _SCENE_OPTIONS + ('checksums',), _run_riomucho_runner))
+
+# calculate_mosaic_pansharpen, which has its own runner
+_MOSAIC_RUNNER = _Runner('mosaics', 'gtiff', (), ('checksums',), None)
+
+
+def _requested_options(options):
+    """Names of the options set to something other than their default"""
+    requested = []
+    for name, value in sorted(options.items(), key=lambda item: item[0]):
+        if name == 'shards':
+            value = value > 1
+        elif name == 'executor':
+            value = value is not None
+        if value:
+            requested.append(name)
+    return requested
+
+
+def _select_runner(backend, options, mosaic=False):
+    """Picks the runner for the requested options
+
+    Parameters
+    ------------
+    backend: 'gtiff' or 'zarr'
+    options: dict
+        option names and values, as passed to calculate_landsat_pansharpen
+    mosaic: boolean
+        check the options against calculate_mosaic_pansharpen instead
+
+    Returns
+    ---------
+    out: _Runner
+        raises _UnsupportedOptions when it does not support all of them
+    """
+    requested = _requested_options(options)
+    if mosaic:
+        runner = _MOSAIC_RUNNER
+    else:
+        runner = next(
+            r for r in _RUNNERS if r.backend == backend and (
+                not r.selects or r.selects.intersection(requested)))
+
+    unsupported = [name for name in requested if name not in runner.supports]
+    if unsupported:
+        raise _UnsupportedOptions(runner, unsupported)
+
+    return runner
 
 
 def calculate_landsat_pansharpen(src_paths, dst_path, dst_dtype,
                                  weight, verbosity, jobs, half_window,
-                                 customwindow, out_alpha, creation_opts):
+                                 customwindow, out_alpha, creation_opts,
+                                 shards=1, executor=None, update=False,
+                                 bounds=None, record_inputs=False,
+                                 prefetch=0, color_bands=None,
+                                 balance=False, checksums=False,
+                                 max_memory=None, backend=None,
+                                 shard_dir=None):
     """Parameters
     ------------
     src_paths: list of string (pan_path, r_path, g_path, b_path)
+        or a pan path followed by any number of color band paths,
+        or a pan path and one multiband color file or VRT
     dst_path: string
     dst_dtype: 'uint16', 'uint8'.
-    weight: float
+    weight: float or sequence of float
+        blue weight of RGB bands, or one weight per color band; all
+        color bands are sharpened in one pass into one output
     jobs: integer
     half_window: boolean
     customwindow: integer
@@ -115,6 +789,50 @@ def calculate_landsat_pansharpen(src_paths, dst_path, dst_dtype,
         output an alpha band?
     creation_opts: dict
         creation options to update the write profile
+    shards: integer
+        split the windows into this many shards, each written to
+        its own chunk and assembled into dst_path (GeoTIFF or .vrt)
+    executor: concurrent.futures.Executor-like, optional
+        anything with a `submit` returning futures, such as a
+        dask.distributed Client, used to run the shards; defaults
+        to a local process pool of `jobs` workers
+    shard_dir: string, optional
+        directory the shards are written to, by default next to
+        dst_path. Workers write the shards and the caller reads them
+        back, so with workers on other nodes it must be storage all of
+        them share, such as an NFS mount
+    update: boolean
+        recompute, in place, only the windows of an existing dst_path
+        that intersect `bounds` or, without bounds, whose inputs differ
+        from the checksums stored by `record_inputs`
+    bounds: tuple, optional
+        (left, bottom, right, top) in the pan CRS
+    record_inputs: boolean
+        store per-window input checksums next to dst_path
+    prefetch: integer
+        number of windows each shard reads ahead, concurrently, while
+        computing; for latency-bound remote inputs. Runs the windows as
+        at least `jobs` shards
+    color_bands: sequence of integer, optional
+        band indexes to sharpen from a single multiband color file;
+        defaults to all of its bands
+    balance: boolean
+        split expensive windows and hand them out largest estimated
+        cost (valid pan pixels) first, then report how busy each
+        worker process was; not with update, shards, executor or prefetch
+    checksums: boolean
+        write per-window checksums of the output to a sidecar
+        manifest, see rio_pansharpen.verify
+    max_memory: integer, optional
+        bytes of window data allowed in flight across workers and the
+        writer queue; windows are split to fit and reads are held back
+        once the budget is used, then peak RSS per process is reported;
+        not with update, shards, executor or prefetch
+    backend: 'gtiff' or 'zarr', optional
+        output format, by default 'zarr' when dst_path ends in .zarr.
+        Zarr output is a local directory store with one chunk per
+        window (customwindow, 512 by default), written directly by
+        the workers; see rio_pansharpen.zarr_store
 
     Returns
     ---------
@@ -122,9 +840,36 @@ def calculate_landsat_pansharpen(src_paths, dst_path, dst_dtype,
         Output is written to dst_path
     """
 
+    backend = backend or _output_backend(dst_path)
+    if backend not in ('gtiff', 'zarr'):
+        raise RuntimeError("Unknown output backend {}".format(backend))
+
+    options = {
+        'update': update, 'bounds': bounds, 'shards': shards,
+        'executor': executor, 'shard_dir': shard_dir,
+        'record_inputs': record_inputs, 'prefetch': prefetch,
+        'color_bands': color_bands, 'balance': balance,
+        'checksums': checksums, 'max_memory': max_memory,
+        'half_window': half_window}
+    runner = _select_runner(backend, options)
+
+    if backend == 'zarr':
+        # chunks follow the windows, so keep them a regular grid
+        # rather than the (often striped) pan blocks
+        customwindow = customwindow or 512
+
     with rasterio.open(src_paths[0]) as pan_src:
         windows = _calc_windows(pan_src, customwindow)
         profile = pan_src.profile
+        bounds_window = _bounds_window(
+            bounds, guard_transform(pan_src.transform)) if bounds else None
+
+        if balance:
+            # decimated read (from overviews when present) for cost
+            # estimates; 0 is nodata
+            valid = pan_src.read(1, out=np.empty(
+                (max(pan_src.height // 32, 1), max(pan_src.width // 32, 1)),
+                dtype=pan_src.dtypes[0])) != 0
 
         if profile['count'] > 1:
             raise RuntimeError(
@@ -132,20 +877,46 @@ def calculate_landsat_pansharpen(src_paths, dst_path, dst_dtype,
 
         dst_dtype = np.__dict__[dst_dtype]
 
+    indexes = []
+    for path in src_paths[1:]:
+        with rasterio.open(path) as color_src:
+            indexes.append(tuple(color_src.indexes))
+
+    if color_bands:
+        if len(indexes) != 1:
+            raise RuntimeError(
+                "Color bands can only be selected from a single "
+                "multiband color file")
+        if not set(color_bands).issubset(indexes[0]):
+            raise RuntimeError(
+                "Color bands {} are not all in {}".format(
+                    list(color_bands), src_paths[1]))
+        indexes = [tuple(color_bands)]
+
+    color_count = sum(len(idx) for idx in indexes)
+    weight = _band_weights(weight, color_count)
+
     profile.update(
         transform=guard_transform(pan_src.transform),
         dtype=dst_dtype,
-        count=3,
-        photometric='rgb')
+        count=color_count)
+
+    if color_count == 3:
+        profile['photometric'] = 'rgb'
 
     if out_alpha:
-        profile['count'] = 4
+        profile['count'] += 1
 
     if creation_opts:
         profile.update(**creation_opts)
 
+    # compress tiles on GDAL worker threads so the single
+    # riomucho writer does not serialize compression
+    _compression_threads(profile, jobs)
+
     with rasterio.open(src_paths[1]) as r_src:
         r_meta = r_src.meta
+        r_tile_shape = _cache_tile_shape(r_src.block_shapes[0])
 
     if profile['width'] <= r_meta['width'] or \
        profile['height'] <= r_meta['height']:
@@ -154,6 +925,27 @@ def calculate_landsat_pansharpen(src_paths, dst_path, dst_dtype,
 
     _check_crs([r_meta, profile])
 
+    if bounds_window is not None:
+        # windows next to the bounds read their 2 pixel rgb halo from
+        # inside them; grow by the halo, plus one for rounding, in pan
+        # pixels
+        bounds_window = _pad_window(bounds_window, int(np.ceil(3 * max(
+            profile['height'] / float(r_meta['height']),
+            profile['width'] / float(r_meta['width'])))))
+
+    # hand windows that read the same rgb tiles to one worker; Zarr
+    # chunks follow the windows, so they must stay a regular grid
+    if backend != 'zarr':
+        windows = _group_windows(
+            windows,
+            (r_meta['height'] / float(profile['height']),
+             r_meta['width'] / float(profile['width'])),
+            r_tile_shape)
+
+    if balance:
+        windows = _balance_windows(
+            windows, valid, (profile['height'], profile['width']), jobs)
+
     g_args = {
         "verb": verbosity,
         "half_window": half_window,
@@ -164,9 +956,240 @@ def calculate_landsat_pansharpen(src_paths, dst_path, dst_dtype,
         "dst_crs": profile['crs'],
         "r_aff": guard_transform(r_meta['transform']),
         "r_crs": r_meta['crs'],
-        "src_nodata": 0}
+        "src_nodata": 0,
+        "prefetch": prefetch,
+        "indexes": indexes}
 
-    with riomucho.RioMucho(src_paths, dst_path, _pansharpen_worker,
+    # tiles cached by an earlier run may be stale
+    _rgb_cache.clear()
+
+    options['bounds_window'] = bounds_window
+    runner.run(src_paths, dst_path, windows, g_args, profile, jobs, options)
+
+    if record_inputs and not update:
+        with open(_inputs_manifest(dst_path), 'w') as f:
+            json.dump(
+                {'windows': _input_checksums(src_paths, windows, g_args)}, f)
+
+    if checksums:
+        write_checksums(dst_path)
+
+
+def _read_scene(open_files, window, indexes, g_args):
+    """Reads one scene's pan, on the output grid, and the color
+    pixels covering an output window
+
+    Returns
+    ---------
+    out: tuple
+        pan array, rgb array and their affine transforms
+    """
+    pan_src, color_srcs = open_files[0], open_files[1:]
+    dst_aff, dst_crs = g_args["dst_aff"], g_args["dst_crs"]
+    shape = (window[0][1] - window[0][0], window[1][1] - window[1][0])
+    pan_affine = dst_aff * Affine.translation(window[1][0], window[0][0])
+
+    pan_transform = guard_transform(pan_src.transform)
+    if pan_src.crs == dst_crs and _aligned(pan_transform, dst_aff):
+        col, row = ~pan_transform * (dst_aff.c, dst_aff.f)
+        pan = pan_src.read(
+            1, window=_offset_window(window, (int(round(row)),
+                                              int(round(col)))),
+            boundless=True)
+    else:
+        pan = np.zeros(shape, dtype=pan_src.dtypes[0])
+        reproject(
+            rasterio.band(pan_src, 1), pan,
+            dst_transform=pan_affine, dst_crs=dst_crs,
+            src_nodata=0, dst_nodata=0,
+            resampling=Resampling.bilinear)
+
+    color_transform = guard_transform(color_srcs[0].transform)
+    if color_srcs[0].crs == dst_crs:
+        rgb_window = _transform_window(window, dst_aff, color_transform)
+    else:
+        xs, ys = zip(dst_aff * (window[1][0], window[0][0]),
+                     dst_aff * (window[1][1], window[0][1]))
+        rgb_window = _bounds_window(
+            transform_bounds(dst_crs, color_srcs[0].crs,
+                             min(xs), min(ys), max(xs), max(ys)),
+            color_transform)
+    rgb_window = _pad_window(rgb_window, 2)
+    rgb_affine = color_transform * Affine.translation(
+        rgb_window[1][0], rgb_window[0][0])
+
+    rgb = np.empty(
+        (g_args["bands"],
+         rgb_window[0][1] - rgb_window[0][0],
+         rgb_window[1][1] - rgb_window[1][0]), dtype=np.float32)
+    start = 0
+    for src, idx in zip(color_srcs, indexes):
+        _read_cached(src, idx, rgb_window, _rgb_cache,
+                     out=rgb[start:start + len(idx)])
+        start += len(idx)
+
+    return pan.astype(np.float32), rgb, pan_affine, rgb_affine
+
+
+def _mosaic_worker(open_files, window, _, g_args):
+    """rio mucho worker for mosaics: pansharpens the scenes whose
+    footprints intersect the window and composites them by alpha
+    """
+    blocksize = g_args["blocksize"]
+    scenes = g_args["index"].get(
+        (window[0][0] // blocksize, window[1][0] // blocksize), [])
+
+    def sharpened():
+        for n in scenes:
+            start, stop = g_args["scenes"][n]
+            pan, rgb, pan_affine, rgb_affine = _read_scene(
+                open_files[start:stop], window, g_args["indexes"][n],
+                g_args)
+            yield _pansharpen_rescaled(
+                rgb, rgb_affine, pan, pan_affine,
+                open_files[start].dtypes[0], open_files[start + 1].crs,
+                g_args["dst_crs"], g_args["weight"], g_args["dst_dtype"],
+                True, src_nodata=g_args["src_nodata"])
+
+    layers = sharpened()
+    if g_args["composite"] == "best":
+        # scenes covering more of the window take priority
+        layers = sorted(
+            layers, key=lambda layer: -np.count_nonzero(layer[-1]))
+
+    out = np.zeros(
+        (g_args["bands"] + 1,
+         window[0][1] - window[0][0], window[1][1] - window[1][0]),
+        dtype=g_args["dst_dtype"])
+    for layer in layers:
+        _fill_invalid(out, layer)
+        # later scenes are not even read once the window is covered
+        if out[-1].all():
+            break
+
+    return out if g_args["out_alpha"] else out[:-1]
+
+
+def calculate_mosaic_pansharpen(scenes, dst_path, dst_dtype, weight,
+                                jobs=1, grid=None, composite='first',
+                                customwindow=512, out_alpha=True,
+                                creation_opts=None, verbosity=False,
+                                checksums=False):
+    """Pansharpens overlapping scenes into one output grid in a
+    single pass, without writing each scene out and mosaicking after
+
+    Parameters
+    ------------
+    scenes: list of list of string
+        one (pan_path, color_path, ...) list per scene, as src_paths
+        of calculate_landsat_pansharpen; every scene needs the same
+        number of color bands
+    dst_path: string
+    dst_dtype: 'uint16', 'uint8'.
+    weight: float or sequence of float
+    jobs: integer
+    grid: tuple, optional
+        (crs, transform, width, height) of the output; defaults to
+        the first scene's pan grid, grown to cover all scenes
+    composite: 'first' or 'best'
+        'first' takes each pixel from the first scene, in order, with
+        it valid; 'best' orders the scenes of each window by how many
+        of its pixels they cover before filling
+    customwindow: integer
+        size of the processing windows
+    out_alpha: boolean
+    creation_opts: dict
+    checksums: boolean
+        write per-window checksums of the output, see verify
+
+    Returns
+    ---------
+    out: None
+        Output is written to dst_path
+    """
+    if composite not in ('first', 'best'):
+        raise RuntimeError("Unknown composite {}".format(composite))
+
+    if not scenes:
+        raise RuntimeError("No scenes to mosaic")
+
+    if _output_backend(dst_path) != 'gtiff':
+        raise RuntimeError("Mosaics are written as GeoTIFF")
+
+    with rasterio.open(scenes[0][0]) as pan_src:
+        profile = pan_src.profile
+        if grid is None:
+            grid = (pan_src.crs, guard_transform(pan_src.transform),
+                    None, None)
+    dst_crs, dst_aff, width, height = grid
+
+    footprints, indexes, spans, src_paths = [], [], [], []
+    for paths in scenes:
+        with rasterio.open(paths[0]) as pan_src:
+            if pan_src.count > 1:
+                raise RuntimeError(
+                    "Pan band must be 1 band - is {}".format(pan_src.count))
+            footprints.append(transform_bounds(
+                pan_src.crs, dst_crs, *pan_src.bounds))
+
+        scene_indexes = []
+        for path in paths[1:]:
+            with rasterio.open(path) as color_src:
+                scene_indexes.append(tuple(color_src.indexes))
+        if [len(idx) for idx in scene_indexes] != \
+                [len(idx) for idx in (indexes or [scene_indexes])[0]]:
+            raise RuntimeError(
+                "Scene {} has different color bands".format(paths[0]))
+        indexes.append(scene_indexes)
+
+        spans.append((len(src_paths), len(src_paths) + len(paths)))
+        src_paths.extend(paths)
+
+    if width is None:
+        dst_aff, width, height = _mosaic_grid(footprints, dst_aff)
+
+    color_count = sum(len(idx) for idx in indexes[0])
+    dst_dtype = np.__dict__[dst_dtype]
+
+    profile.update(
+        crs=dst_crs, transform=dst_aff, width=width, height=height,
+        dtype=dst_dtype, count=color_count + (1 if out_alpha else 0),
+        nodata=None)
+    if color_count == 3:
+        profile['photometric'] = 'rgb'
+    if creation_opts:
+        profile.update(**creation_opts)
+    _compression_threads(profile, jobs)
+
+    blocksize = _adjust_block_size(width, height, customwindow or 512)
+    index = _footprint_index(footprints, dst_aff, (height, width), blocksize)
+    # windows no scene touches stay empty
+    windows = [
+        (window, (0, 0))
+        for window in _make_windows(width, height, blocksize)
+        if (window[0][0] // blocksize, window[1][0] // blocksize) in index]
+
+    g_args = {
+        "verb": verbosity,
+        "dst_dtype": dst_dtype,
+        "out_alpha": out_alpha,
+        "weight": _band_weights(weight, color_count),
+        "dst_aff": dst_aff,
+        "dst_crs": dst_crs,
+        "src_nodata": 0,
+        "indexes": indexes,
+        "scenes": spans,
+        "index": index,
+        "blocksize": blocksize,
+        "bands": color_count,
+        "composite": composite}
+
+    _rgb_cache.clear()
+
+    with riomucho.RioMucho(src_paths, dst_path, _mosaic_worker,
                            windows=windows, global_args=g_args,
                            options=profile, mode='manual_read') as rm:
         rm.run(jobs)
+
+    if checksums:
+        write_checksums(dst_path)
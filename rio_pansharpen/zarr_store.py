@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+"""Zarr output, for analysis pipelines that read chunked arrays.
+
+The array has shape (bands, height, width) with one chunk per
+processing window, so workers write their chunks directly and in
+parallel, and readers can load sub-regions lazily. Georeferencing is
+kept in the array attributes:
+
+- ``transform``: affine coefficients (a, b, c, d, e, f)
+- ``crs``: WKT
+- ``alpha``: whether the last band is an alpha band
+
+Needs the optional zarr package: pip install rio-pansharpen[zarr]
+"""
+from __future__ import division
+
+from affine import Affine
+
+
+def _import_zarr():
+    try:
+        import zarr
+    except ImportError:
+        raise RuntimeError(
+            "Zarr output needs the zarr package: "
+            "pip install rio-pansharpen[zarr]")
+    return zarr
+
+
+def _zarr_chunks(windows):
+    """Chunk shape of a regular grid of ((row_start, row_stop),
+    (col_start, col_stop)) windows: the shape of its full windows
+    """
+    return (max(w[0][1] - w[0][0] for w, _ in windows),
+            max(w[1][1] - w[1][0] for w, _ in windows))
+
+
+def _check_chunks(windows, chunks):
+    """Raises unless every window lies inside a single chunk, so
+    concurrent writers never share one
+    """
+    for window, _ in windows:
+        if any(w[0] // c != (w[1] - 1) // c for w, c in zip(window, chunks)):
+            raise RuntimeError(
+                "Window {} crosses Zarr chunks of {}".format(
+                    window, chunks))
+
+
+def create_zarr(path, profile, chunks, alpha=True):
+    """Creates an empty Zarr array in a local directory store
+
+    Parameters
+    ------------
+    path: string
+    profile: dict
+        rasterio write profile: count, height, width, dtype,
+        transform and crs
+    chunks: tuple of integer
+        (rows, cols) of each chunk; all bands share a chunk
+    alpha: boolean
+        is the last band an alpha band?
+    """
+    zarr = _import_zarr()
+    arr = zarr.open_array(
+        store=path, mode='w',
+        shape=(profile['count'], profile['height'], profile['width']),
+        chunks=(profile['count'],) + tuple(chunks),
+        dtype=profile['dtype'], fill_value=0)
+    arr.attrs.update({
+        'transform': [float(v) for v in tuple(profile['transform'])[:6]],
+        'crs': profile['crs'].wkt,
+        'alpha': bool(alpha)})
+    return arr
+
+
+def open_zarr(path, mode='r'):
+    """Opens a pansharpened Zarr array
+
+    Returns
+    ---------
+    out: tuple
+        (array, transform) where transform is an Affine
+    """
+    arr = _import_zarr().open_array(store=path, mode=mode)
+    return arr, Affine(*arr.attrs['transform'])
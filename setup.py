@@ -37,6 +37,7 @@ setup(name='rio-pansharpen',
       ],
       extras_require={
           'test': ['pytest', 'hypothesis', 'pytest-cov', 'codecov'],
+          'zarr': ['zarr'],
       },
       entry_points="""
       [rasterio.rio_plugins]
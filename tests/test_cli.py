@@ -1,4 +1,6 @@
 import re
+import subprocess
+import sys
 
 import click
 from click.testing import CliRunner
@@ -133,3 +135,39 @@ def test_creation_opts(tmpdir):
     assert result.exit_code == 0
     with rasterio.open(output) as src:
         assert src.compression.value == 'JPEG'
+
+
+@pytest.mark.parametrize("opts", [
+    ['--max-memory', '64', '--shards', '2'],
+    ['--max-memory', '64', '--prefetch', '4'],
+    ['--balance', '--shards', '2']])
+def test_exclusive_options(tmpdir, opts):
+    output = str(tmpdir.join('exclusive.TIF'))
+    runner = CliRunner()
+    result = runner.invoke(
+        pansharpen,
+        ['tests/fixtures/tiny_20_tiffs/LC81070352015122LGN00/'
+         'LC81070352015122LGN00_B4.tif',
+         'tests/fixtures/tiny_20_tiffs/LC81070352015122LGN00/'
+         'LC81070352015122LGN00_B3.tif',
+         'tests/fixtures/tiny_20_tiffs/LC81070352015122LGN00/'
+         'LC81070352015122LGN00_B2.tif',
+         output] + opts)
+
+    assert result.exit_code != 0
+    assert 'not supported by' in result.output
+
+
+def test_cli_import_is_light():
+    # rio imports every plugin on startup; keep ours cheap
+    output = subprocess.check_output(
+        [sys.executable, '-c',
+         'import sys, rio_pansharpen.scripts.cli; '
+         'print("\\n".join(sys.modules))'],
+        universal_newlines=True)
+    imported = set(output.split())
+
+    assert 'rio_pansharpen.scripts.cli' in imported
+    for heavy in ('rio_pansharpen.worker', 'riomucho', 'rasterio.warp',
+                  'asyncio'):
+        assert heavy not in imported
@@ -4,8 +4,16 @@ from rio_pansharpen import utils
 import numpy as np
 import rio_pansharpen.methods as pansharp_methods
 import rasterio
-from rio_pansharpen.worker import _pansharpen_worker
-from rio_pansharpen.utils import _calc_windows, _half_window
+from rio_pansharpen.worker import (
+    _pansharpen_worker, pansharpen_array, pansharpen_blocks,
+    calculate_mosaic_pansharpen)
+from rio_pansharpen.utils import (
+    _calc_windows, _half_window, _compression_threads, _shard_profile,
+    _BlockCache, _read_cached, _group_windows, _shard_windows, _shard_vrt,
+    _intersecting_windows, _window_key, _checksum, _band_weights,
+    _balance_windows, _utilization_report, _window_bytes, _fit_windows,
+    _MemoryBudget, _peak_rss_report, _output_backend, _bounds_window,
+    _aligned, _mosaic_grid, _footprint_index, _fill_invalid)
 
 
 # Creating random test fixture for advance functions
@@ -60,7 +68,715 @@ def test_calc_windows_customwindows(test_pansharp_data):
 
     w = _calc_windows(open_files[0], 1024)
     assert w[0] == (((0, 1024), (0, 1024)), (0, 0))
-    assert w[1] == (((1024, 2048), (0, 1024)), (0, 0))
+    assert w[1] == (((0, 1024), (1024, 2048)), (0, 0))
+
+
+@pytest.mark.parametrize('profile,jobs,expected', (
+    ({'compress': 'deflate'}, 4, 4),
+    ({'compress': 'zstd', 'num_threads': 'all_cpus'}, 4, 'all_cpus'),
+    ({'compress': None}, 4, None),
+    ({}, 4, None)))
+def test_compression_threads(profile, jobs, expected):
+    assert _compression_threads(profile, jobs).get('num_threads') == expected
+
+
+def test_shard_profile():
+    profile = _compression_threads({'compress': 'deflate'}, 8)
+    assert _shard_profile(profile) == {'compress': 'deflate',
+                                       'num_threads': 1}
+    # the assembled output keeps its encoder threads
+    assert profile['num_threads'] == 8
+    assert _shard_profile({'compress': 'none'}) == {'compress': 'none'}
+
+
+def test_group_windows():
+    windows = [(((y, y + 256), (x, x + 256)), (y // 256, x // 256))
+               for y in range(0, 768, 256) for x in range(0, 768, 256)]
+    grouped = _group_windows(windows, (0.5, 0.5), (256, 256))
+    assert grouped[0] == (((0, 512), (0, 512)), (0, 0))
+    assert len(grouped) == 4
+    assert sum((w[0][1] - w[0][0]) * (w[1][1] - w[1][0])
+               for w, _ in grouped) == 768 * 768
+
+    # striped rgb: one tile row spans the scene, but merged windows
+    # stay within 4 pan windows
+    windows = [(((0, 512), (x, min(x + 512, 15400))), (0, x // 512))
+               for x in range(0, 15400, 512)]
+    grouped = _group_windows(windows, (0.5, 0.5), (256, 7800))
+    assert len(grouped) == 8
+    assert grouped[0] == (((0, 512), (0, 2048)), (0, 0))
+    assert all((w[0][1] - w[0][0]) * (w[1][1] - w[1][0]) <= 4 * 512 * 512
+               for w, _ in grouped)
+    assert sum(w[1][1] - w[1][0] for w, _ in grouped) == 15400
+
+
+def test_block_cache_bytes():
+    cache = _BlockCache(maxsize=64, maxbytes=3000)
+    for i in range(4):
+        cache.put(i, np.zeros(1000, dtype=np.uint8))
+    assert cache.get(0) is None
+    assert cache.nbytes == 3000
+    # the newest tile stays even when larger than the budget
+    cache.put('big', np.zeros(5000, dtype=np.uint8))
+    assert cache.get('big') is not None
+    assert cache.get(3) is None
+    assert cache.nbytes == 5000
+
+
+def test_read_cached():
+    path = 'tests/fixtures/tiny_20_tiffs/LC81070352015122LGN00/'\
+           'LC81070352015122LGN00_B4.tif'
+    cache = _BlockCache(maxsize=4)
+    with rasterio.open(path) as src:
+        full = src.read()
+        window = ((-2, 300), (1400, src.width + 2))
+        out = _read_cached(src, src.indexes, window, cache)
+        assert len(cache._tiles) == 4
+
+        expected = np.zeros((1, 302, src.width + 2 - 1400), dtype=full.dtype)
+        expected[:, 2:, :-2] = full[:, :300, 1400:]
+        assert np.array_equal(out, expected)
+
+        again = _read_cached(src, src.indexes, window, cache)
+        assert np.array_equal(again, out)
+        assert len(cache._tiles) == 4
+
+
+def test_read_cached_multiband(tmpdir):
+    paths = ['tests/fixtures/tiny_20_tiffs/LC81070352015122LGN00/'
+             'LC81070352015122LGN00_B%d.tif' % b for b in (4, 3, 2)]
+    bands = [rasterio.open(path) for path in paths]
+    profile = bands[0].profile
+    profile.update(count=3)
+    path = str(tmpdir.join('rgb.tif'))
+    with rasterio.open(path, 'w', **profile) as dst:
+        dst.write(np.concatenate([src.read() for src in bands]))
+
+    window = ((100, 400), (-2, 300))
+    cache = _BlockCache(maxsize=8)
+    with rasterio.open(path) as src:
+        out = np.empty((2, 300, 302), dtype=np.float32)
+        _read_cached(src, (3, 1), window, cache, out=out)
+
+    for got, single in zip(out, (bands[2], bands[0])):
+        expected = _read_cached(single, (1,), window, _BlockCache(4))
+        assert np.array_equal(got, expected[0])
+
+
+def test_shard_windows():
+    windows = [(((y, y + 256), (x, x + 256)), (0, 0))
+               for y in range(0, 1024, 256) for x in range(0, 512, 256)]
+    shards = _shard_windows(windows, 3)
+    assert [len(shard) for shard in shards] == [4, 2, 2]
+    assert sorted(w for shard in shards for w in shard) == sorted(windows)
+    rows = [set(w[0] for w, _ in shard) for shard in shards]
+    assert not rows[0] & rows[1] and not rows[1] & rows[2]
+
+    assert len(_shard_windows(windows, 10)) == 4
+
+
+def test_shard_vrt():
+    from xml.etree import ElementTree
+    profile = {'width': 512, 'height': 1024, 'count': 4, 'dtype': 'uint8',
+               'photometric': 'rgb',
+               'crs': rasterio.crs.CRS.from_epsg(32654),
+               'transform': Affine(15.0, 0.0, 300885.0,
+                                   0.0, -15.0, 4107015.0)}
+    shards = [('/tmp/out.shard0000.tif', ((0, 512), (0, 512))),
+              ('/tmp/out.shard0001.tif', ((512, 1024), (0, 512)))]
+    vrt = ElementTree.fromstring(_shard_vrt(shards, profile))
+    bands = vrt.findall('VRTRasterBand')
+    assert len(bands) == 4
+    assert bands[3].find('ColorInterp').text == 'Alpha'
+    sources = bands[0].findall('SimpleSource')
+    assert sources[1].find('SourceFilename').text == 'out.shard0001.tif'
+    assert sources[1].find('DstRect').get('yOff') == '512'
+
+
+def test_intersecting_windows():
+    windows = [(((y, y + 256), (x, x + 256)), (0, 0))
+               for y in range(0, 1024, 256) for x in range(0, 1024, 256)]
+    hits = _intersecting_windows(windows, ((300, 520), (0, 256)))
+    assert [w for w, _ in hits] == [((256, 512), (0, 256)),
+                                    ((512, 768), (0, 256))]
+    assert _intersecting_windows(windows, ((1024, 2048), (0, 10))) == []
+
+
+def test_checksum():
+    arr = np.arange(12, dtype=np.uint16).reshape(3, 4)
+    assert _checksum([arr, arr[:1]]) == _checksum([arr.copy(), arr[:1]])
+    assert _checksum([arr]) != _checksum([arr + 1])
+    assert _checksum([arr[:, ::2]]) == _checksum([arr[:, ::2].copy()])
+    assert _window_key(((0, 256), (512, 768))) == '0:256,512:768'
+
+
+@pytest.fixture
+def synthetic_scene(tmpdir):
+    """A 400 px crop of the color fixtures, written to tmpdir, and a
+    synthetic 800 px pan band made from the red band
+    """
+    path = 'tests/fixtures/tiny_20_tiffs/LC81070352015122LGN00/'\
+           'LC81070352015122LGN00_B%d.tif'
+    src_paths = []
+    for band in (4, 3, 2):
+        with rasterio.open(path % band) as src:
+            profile = src.profile
+            transform = src.transform * Affine.translation(600, 600)
+            data = src.read(1, window=((600, 1000), (600, 1000)))
+        profile.update(width=400, height=400, transform=transform)
+        src_paths.append(str(tmpdir.join('B%d.tif' % band)))
+        with rasterio.open(src_paths[-1], 'w', **profile) as dst:
+            dst.write(data, 1)
+        if band == 4:
+            pan = np.kron(data, np.ones((2, 2), dtype=data.dtype))
+
+    profile.update(width=800, height=800,
+                   transform=transform * Affine.scale(0.5))
+    pan_path = str(tmpdir.join('B8.tif'))
+    with rasterio.open(pan_path, 'w', **profile) as dst:
+        dst.write(pan, 1)
+
+    return [pan_path] + src_paths
+
+
+@pytest.fixture
+def http_fixtures():
+    import os
+    import threading
+    from socketserver import ThreadingMixIn
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+    class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    class RangeHandler(BaseHTTPRequestHandler):
+        """Serves tests/fixtures, honoring single range requests"""
+        def do_HEAD(self):
+            self.do_GET(body=False)
+
+        def do_GET(self, body=True):
+            path = os.path.join('tests/fixtures', self.path.lstrip('/'))
+            if not os.path.isfile(path):
+                self.send_error(404)
+                return
+            with open(path, 'rb') as f:
+                data = f.read()
+            start, end = 0, len(data) - 1
+            if 'Range' in self.headers:
+                first, last = self.headers['Range'].split('=')[1].split('-')
+                start = int(first)
+                end = min(int(last), end) if last else end
+                self.send_response(206)
+                self.send_header('Content-Range', 'bytes %d-%d/%d' % (
+                    start, end, len(data)))
+            else:
+                self.send_response(200)
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('Content-Length', str(end - start + 1))
+            self.end_headers()
+            if body:
+                self.wfile.write(data[start:end + 1])
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), RangeHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield 'http://127.0.0.1:%d' % server.server_port
+    server.shutdown()
+
+
+def test_prefetch(http_fixtures):
+    from rio_pansharpen.prefetch import prefetch
+    names = ['tiny_20_tiffs/LC81070352015122LGN00/'
+             'LC81070352015122LGN00_B%d.tif' % b for b in (4, 3, 2)]
+    windows = [((y, y + 256), (x, x + 256))
+               for y in range(0, 1024, 256) for x in range(0, 1024, 256)]
+
+    def read(open_files, window):
+        return np.concatenate([src.read(window=window) for src in open_files])
+
+    remote = ['/vsicurl/%s/%s' % (http_fixtures, name) for name in names]
+    local = [rasterio.open('tests/fixtures/' + name) for name in names]
+    with rasterio.Env(GDAL_DISABLE_READDIR_ON_OPEN='EMPTY_DIR'):
+        results = list(prefetch(remote, read, windows, depth=3))
+
+    assert [window for window, _ in results] == windows
+    for window, data in results:
+        assert np.array_equal(data, read(local, window))
+
+
+def test_prefetch_error():
+    from rio_pansharpen.prefetch import prefetch
+
+    def read(open_files, item):
+        if item == 3:
+            raise ValueError('bad window')
+        return item
+
+    with pytest.raises(ValueError):
+        list(prefetch([], read, range(10), depth=2))
+
+
+def test_band_weights():
+    assert _band_weights(0.2, 3) == 0.2
+    assert _band_weights([1, 1, 1, 0.2], 4) == (1.0, 1.0, 1.0, 0.2)
+    with pytest.raises(RuntimeError):
+        _band_weights(0.2, 4)
+    with pytest.raises(RuntimeError):
+        _band_weights([1, 1, 0.2], 4)
+
+
+def test_brovey_bands(test_data):
+    pan = test_data[0]
+    up_rgb = np.array([
+        (np.random.rand(60, 60) * 255).astype(np.uint8)
+        for i in range(5)
+        ])
+    sharp, ratio = pansharp_methods.Brovey(
+        up_rgb, pan, (1, 1, 1, 1, 0.2), pan.dtype)
+    assert sharp.shape == (5, 60, 60)
+    assert ratio.shape == (60, 60)
+
+
+def test_balance_windows():
+    windows = [(((y, y + 1024), (x, x + 1024)), (0, 0))
+               for y in range(0, 2048, 1024) for x in range(0, 2048, 1024)]
+    # only the top left window has data
+    valid = np.zeros((64, 64), dtype=bool)
+    valid[:32, :32] = True
+
+    balanced = _balance_windows(windows, valid, (2048, 2048), 2)
+    # only the expensive window is split; empty windows are cheap per
+    # pixel but still larger than each piece
+    assert len(balanced) == 3 + 16
+    assert all(w[0][1] <= 1024 and w[1][1] <= 1024 for w, _ in balanced[3:])
+    assert sum((w[0][1] - w[0][0]) * (w[1][1] - w[1][0])
+               for w, _ in balanced) == 2048 * 2048
+
+    assert len(_balance_windows(windows, ~valid, (2048, 2048), 1)) == 4
+
+
+def test_utilization_report():
+    assert _utilization_report({12: 1.5, 11: 3.0}, 3.0) == [
+        'worker 11: busy 3.00s of 3.00s (100%)',
+        'worker 12: busy 1.50s of 3.00s (50%)']
+
+
+def test_window_bytes():
+    window = ((0, 100), (0, 200))
+    assert _window_bytes(window, 3, 'uint8') == 20000 * (4 + 24 + 4)
+    assert _window_bytes(window, 3, 'uint16') == 20000 * (4 + 24 + 8)
+
+
+def test_fit_windows():
+    windows = [(((0, 1024), (0, 1024)), (0, 0)),
+               (((0, 1024), (1024, 1100)), (0, 1))]
+
+    def nbytes(window):
+        return _window_bytes(window, 3, 'uint8')
+
+    fitted = _fit_windows(windows, nbytes(((0, 512), (0, 512))), nbytes)
+    assert len(fitted) == 5
+    assert all(nbytes(w) <= nbytes(((0, 512), (0, 512)))
+               for w, _ in fitted[:4])
+    # too narrow to split any further
+    assert fitted[4] == windows[1]
+
+    assert _fit_windows(windows, 1, nbytes, minsize=1024) == windows
+
+
+def test_memory_budget():
+    import threading
+    budget = _MemoryBudget(100)
+    budget.acquire(60)
+    # larger than the budget, but admitted once nothing is in flight
+    acquired = threading.Event()
+
+    def big():
+        budget.acquire(150)
+        acquired.set()
+
+    thread = threading.Thread(target=big)
+    thread.start()
+    assert not acquired.wait(0.2)
+    budget.release(60)
+    assert acquired.wait(5)
+    thread.join()
+    assert budget.in_flight == 150
+
+    # abort wakes waiters, which then give up
+    results = []
+    thread = threading.Thread(target=lambda: results.append(
+        budget.acquire(10)))
+    thread.start()
+    budget.abort()
+    thread.join(5)
+    assert results == [False]
+    assert not budget.acquire(1)
+
+
+def test_exclusive_options():
+    from rio_pansharpen.worker import calculate_landsat_pansharpen
+    for kwargs in ({'max_memory': 2 ** 26, 'shards': 2},
+                   {'max_memory': 2 ** 26, 'update': True},
+                   {'balance': True, 'executor': object()},
+                   {'balance': True, 'prefetch': 4}):
+        with pytest.raises(RuntimeError):
+            calculate_landsat_pansharpen(
+                ['pan.tif', 'rgb.tif'], 'out.tif', 'uint8', 0.2, False, 2,
+                False, None, True, {}, **kwargs)
+
+
+def test_select_runner():
+    from rio_pansharpen import worker
+    defaults = {'update': False, 'shards': 1, 'executor': None,
+                'prefetch': 0, 'balance': False, 'max_memory': None,
+                'checksums': True}
+
+    def select(backend='gtiff', mosaic=False, **kwargs):
+        options = dict(defaults, **kwargs)
+        return worker._select_runner(backend, options, mosaic).name
+
+    assert select() == 'single-writer runs'
+    assert select(balance=True) == 'balanced runs'
+    assert select(max_memory=2 ** 26, balance=True) == 'memory-bounded runs'
+    assert select(prefetch=4) == 'sharded runs'
+    assert select(update=True, shards=4) == 'updates'
+    assert select(mosaic=True) == 'mosaics'
+    assert select('zarr', checksums=False) == 'Zarr output'
+
+    for backend, mosaic, kwargs, unsupported in (
+            ('gtiff', False, {'bounds': (0, 0, 1, 1)}, ['bounds']),
+            ('gtiff', False, {'shards': 2, 'balance': True}, ['balance']),
+            ('gtiff', True, {'update': True}, ['update']),
+            ('zarr', False, {}, ['checksums'])):
+        with pytest.raises(worker._UnsupportedOptions) as exc:
+            select(backend, mosaic, **kwargs)
+        assert exc.value.options == unsupported
+
+
+def test_run_bounded_worker_error(tmpdir, monkeypatch):
+    import threading
+    from rio_pansharpen import worker
+    from rasterio.crs import CRS
+
+    def failing(open_files, window, ij, g_args):
+        if window[0][0] >= 1024:
+            raise ValueError('bad window')
+        return np.zeros((4, window[0][1] - window[0][0],
+                         window[1][1] - window[1][0]), dtype=np.uint8)
+
+    monkeypatch.setattr(worker, '_pansharpen_worker', failing)
+    src = 'tests/fixtures/tiny_20_tiffs/LC81070352015122LGN00/'\
+          'LC81070352015122LGN00_B4.tif'
+    profile = {'driver': 'GTiff', 'dtype': 'uint8', 'count': 4,
+               'width': 1500, 'height': 1300, 'crs': CRS.from_epsg(3857),
+               'transform': Affine(15.0, 0.0, 0.0, 0.0, -15.0, 0.0)}
+    windows = [(w, (0, 0)) for w in utils._make_windows(1500, 1300, 512)]
+
+    errors = []
+
+    def run():
+        try:
+            worker._run_bounded(
+                [src], str(tmpdir.join('out.tif')), windows,
+                {'out_alpha': True}, profile, 2, 2 * 2 ** 20, False)
+        except Exception as exc:
+            errors.append(exc)
+
+    # a tight budget keeps the task feeder blocked when the worker fails
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    thread.join(60)
+    assert not thread.is_alive()
+    assert len(errors) == 1
+
+
+def test_peak_rss_report():
+    assert _peak_rss_report({12: 2 ** 20, 11: 3 * 2 ** 20, 13: None}) == [
+        'process 11: peak RSS 3.0 MB',
+        'process 12: peak RSS 1.0 MB']
+
+
+def test_output_backend():
+    assert _output_backend('out.tif') == 'gtiff'
+    assert _output_backend('out.vrt') == 'gtiff'
+    assert _output_backend('/data/out.zarr') == 'zarr'
+    assert _output_backend('/data/OUT.ZARR/') == 'zarr'
+
+
+def test_zarr_store(tmpdir):
+    pytest.importorskip('zarr')
+    from rasterio.crs import CRS
+    from rio_pansharpen.zarr_store import (
+        create_zarr, open_zarr, _zarr_chunks)
+
+    windows = [(((0, 512), (0, 512)), (0, 0)),
+               (((0, 512), (512, 700)), (0, 0)),
+               (((512, 600), (0, 512)), (0, 0)),
+               (((512, 600), (512, 700)), (0, 0))]
+    assert _zarr_chunks(windows) == (512, 512)
+
+    path = str(tmpdir.join('out.zarr'))
+    aff = Affine(15.0, 0.0, 300000.0, 0.0, -15.0, 4100000.0)
+    profile = {'count': 4, 'height': 600, 'width': 700, 'dtype': 'uint8',
+               'transform': aff, 'crs': CRS.from_epsg(32654)}
+    create_zarr(path, profile, (512, 512))
+
+    dst, transform = open_zarr(path, mode='r+')
+    assert dst.shape == (4, 600, 700)
+    assert dst.chunks == (4, 512, 512)
+    assert transform == aff
+    assert CRS.from_wkt(dst.attrs['crs']) == profile['crs']
+    assert dst.attrs['alpha']
+
+    dst[:, 512:600, 512:700] = 7
+    arr, _ = open_zarr(path)
+    assert arr[:, 500:, 500:].sum() == 4 * 88 * 188 * 7
+
+
+def test_mosaic_grid():
+    aff = Affine(15.0, 0.0, 300000.0, 0.0, -15.0, 4100000.0)
+    assert _bounds_window((300150, 4099700, 300300, 4100000), aff) == \
+        ((0, 20), (10, 20))
+    assert _aligned(aff * Affine.translation(-3, 7), aff)
+    assert not _aligned(aff * Affine.translation(0.5, 0), aff)
+    assert not _aligned(aff * Affine.scale(2), aff)
+
+    footprints = [(300150, 4099700, 300300, 4100000),
+                  (299700, 4099400, 300000, 4099850)]
+    transform, width, height = _mosaic_grid(footprints, aff)
+    assert transform == aff * Affine.translation(-20, 0)
+    assert (width, height) == (40, 40)
+
+    index = _footprint_index(footprints, transform, (height, width), 16)
+    assert index == {(0, 1): [0, 1], (0, 2): [0], (1, 1): [0, 1],
+                     (1, 2): [0], (0, 0): [1], (1, 0): [1], (2, 0): [1],
+                     (2, 1): [1]}
+
+
+def test_fill_invalid():
+    mosaic = np.zeros((2, 2, 2), dtype=np.uint8)
+    first = np.array([[[1, 1], [1, 1]], [[255, 0], [0, 0]]], dtype=np.uint8)
+    second = np.array([[[2, 2], [2, 2]], [[255, 255], [0, 0]]],
+                      dtype=np.uint8)
+    _fill_invalid(mosaic, first)
+    _fill_invalid(mosaic, second)
+    assert mosaic[0].tolist() == [[1, 2], [0, 0]]
+    assert mosaic[1].tolist() == [[255, 255], [0, 0]]
+
+
+def test_mosaic_pansharpen(tmpdir):
+    path = 'tests/fixtures/tiny_20_tiffs/LC81070352015122LGN00/'\
+           'LC81070352015122LGN00_B%d.tif'
+    vis = []
+    for band in (4, 3, 2):
+        with rasterio.open(path % band) as src:
+            profile = src.profile
+            vis_aff = src.transform * Affine.translation(600, 600)
+            vis.append(src.read(1, window=((600, 900), (600, 900))))
+    vis = np.array(vis)
+    # a synthetic pan band at twice the resolution
+    pan = np.kron(vis.max(axis=0), np.ones((2, 2), dtype=vis.dtype))
+    pan_aff = vis_aff * Affine.scale(0.5)
+    ref = pansharpen_array(pan, pan_aff, vis, vis_aff, 0.2,
+                           crs=profile['crs'], blocksize=256)
+
+    def write(name, arr, transform):
+        out = str(tmpdir.join(name))
+        options = dict(profile, width=arr.shape[1], height=arr.shape[0],
+                       transform=transform, tiled=False)
+        options.pop('blockxsize', None)
+        options.pop('blockysize', None)
+        with rasterio.open(out, 'w', **options) as dst:
+            dst.write(arr, 1)
+        return out
+
+    # two scenes overlapping by 60 color columns
+    scenes = []
+    for n, (start, stop) in enumerate(((0, 180), (120, 300))):
+        scenes.append(
+            [write('%d_pan.tif' % n, pan[:, 2 * start:2 * stop],
+                   pan_aff * Affine.translation(2 * start, 0))] +
+            [write('%d_%d.tif' % (n, b), vis[b][:, start:stop],
+                   vis_aff * Affine.translation(start, 0))
+             for b in range(3)])
+
+    dst_path = str(tmpdir.join('mosaic.tif'))
+    calculate_mosaic_pansharpen(scenes[:1], dst_path, 'uint8', 0.2,
+                                customwindow=256)
+    with rasterio.open(dst_path) as src:
+        assert src.shape == (600, 360)
+        # the last column has no color neighbors past the scene edge
+        assert np.array_equal(src.read()[:, :, :-1], ref[:, :, :359])
+
+    calculate_mosaic_pansharpen(scenes, dst_path, 'uint8', 0.2,
+                                customwindow=256, composite='best')
+    with rasterio.open(dst_path) as src:
+        assert src.shape == (600, 600)
+        assert np.array_equal(src.read(), ref)
+
+    with pytest.raises(RuntimeError):
+        calculate_mosaic_pansharpen(scenes, dst_path, 'uint8', 0.2,
+                                    composite='median')
+
+
+def test_zarr_jobs(tmpdir, monkeypatch, synthetic_scene):
+    pytest.importorskip('zarr')
+    from rio_pansharpen import worker
+    from rio_pansharpen.zarr_store import open_zarr, _check_chunks
+
+    with pytest.raises(RuntimeError):
+        _check_chunks([(((0, 400), (0, 200)), (0, 0))], (200, 200))
+
+    def coords(open_files, window, ij, g_args):
+        rows = np.arange(*window[0])[:, None]
+        cols = np.arange(*window[1])[None, :]
+        return np.broadcast_to(
+            ((rows * 7 + cols) % 251).astype(np.uint8),
+            (4, rows.shape[0], cols.shape[1]))
+
+    # forked worker processes inherit the patched window function
+    monkeypatch.setattr(worker, '_pansharpen_worker', coords)
+
+    rows = np.arange(800)[:, None]
+    cols = np.arange(800)[None, :]
+    expected = ((rows * 7 + cols) % 251).astype(np.uint8)
+    for jobs in (1, 4):
+        dst_path = str(tmpdir.join('out_%d.zarr' % jobs))
+        # not a multiple of the rgb tiles, which grouping would merge
+        worker.calculate_landsat_pansharpen(
+            synthetic_scene, dst_path, 'uint8', 0.2, False, jobs, False,
+            200, True, {})
+        arr, _ = open_zarr(dst_path)
+        assert arr.chunks[1:] == (200, 200)
+        assert np.array_equal(arr[0], expected)
+        assert np.array_equal(arr[3], expected)
+
+
+def test_update(tmpdir, synthetic_scene):
+    from rio_pansharpen.worker import calculate_landsat_pansharpen
+
+    def run(dst_path, **kwargs):
+        calculate_landsat_pansharpen(
+            synthetic_scene, dst_path, 'uint8', 0.2, False, 2, False, 256,
+            True, {}, **kwargs)
+        with rasterio.open(dst_path) as src:
+            return src.read()
+
+    by_bounds = str(tmpdir.join('by_bounds.tif'))
+    by_inputs = str(tmpdir.join('by_inputs.tif'))
+    original = run(by_bounds)
+    run(by_inputs, record_inputs=True)
+
+    # halve red rows ending on the pan window edge at row 512 (256 px
+    # windows merge by rgb tile); the windows below still read them
+    # through their rgb halo
+    with rasterio.open(synthetic_scene[1], 'r+') as src:
+        red = src.read(1)
+        red[246:256] //= 2
+        src.write(red, 1)
+    with rasterio.open(synthetic_scene[0]) as pan:
+        left, top = pan.transform * (0, 492)
+        right, bottom = pan.transform * (800, 512)
+
+    updated = run(by_bounds, update=True, bounds=(left, bottom, right, top))
+    expected = run(str(tmpdir.join('full.tif')))
+    assert not np.array_equal(updated, original)
+    assert np.array_equal(updated, expected)
+
+    assert np.array_equal(run(by_inputs, update=True), expected)
+
+    with pytest.raises(RuntimeError):
+        run(str(tmpdir.join('out.vrt')), update=True,
+            bounds=(left, bottom, right, top))
+
+
+def test_sharded(tmpdir, synthetic_scene):
+    from concurrent.futures import ThreadPoolExecutor
+    from rio_pansharpen.worker import calculate_landsat_pansharpen
+
+    def run(dst_path, **kwargs):
+        calculate_landsat_pansharpen(
+            synthetic_scene, dst_path, 'uint8', 0.2, False, 2, False, 256,
+            True, {}, **kwargs)
+        with rasterio.open(dst_path) as src:
+            return src.read()
+
+    expected = run(str(tmpdir.join('whole.tif')))
+
+    shard_dir = tmpdir.mkdir('shards')
+    assert np.array_equal(
+        run(str(tmpdir.join('sharded.tif')), shards=3,
+            shard_dir=str(shard_dir)), expected)
+    # shards are removed once copied into the output
+    assert shard_dir.listdir() == []
+
+    vrt_path = str(tmpdir.join('out.vrt'))
+    with ThreadPoolExecutor(2) as pool:
+        assert np.array_equal(
+            run(vrt_path, shards=3, executor=pool), expected)
+    referenced = set(tmpdir.listdir(lambda p: '.shard' in p.basename))
+    assert referenced
+
+    # a later sharded run next to the VRT leaves its shards alone
+    run(str(tmpdir.join('out.tif')), shards=3)
+    assert set(tmpdir.listdir(
+        lambda p: '.shard' in p.basename)) == referenced
+    with rasterio.open(vrt_path) as src:
+        assert np.array_equal(src.read(), expected)
+
+
+def test_pansharpen_array():
+    pan = (np.random.rand(700, 600) * 60000 + 1000).astype(np.uint16)
+    vis = (np.random.rand(3, 350, 300) * 60000 + 1000).astype(np.uint16)
+    pan_aff = Affine(15.0, 0.0, 300000.0, 0.0, -15.0, 4100000.0)
+    vis_aff = Affine(30.0, 0.0, 300000.0, 0.0, -30.0, 4100000.0)
+
+    out = pansharpen_array(pan, pan_aff, vis, vis_aff, 0.2, blocksize=256)
+    assert out.shape == (4, 700, 600)
+    assert out.dtype == np.uint8
+    assert np.all(out[3] == 255)
+
+    # windowed output matches sharpening the arrays in one block
+    padded = np.pad(vis, ((0, 0), (2, 2), (2, 2)), mode='constant')
+    whole = next(pansharpen_blocks(
+        [(pan, padded, pan_aff, vis_aff * Affine.translation(-2, -2))],
+        0.2))
+    assert np.array_equal(whole, out)
+
+
+def test_verify(tmpdir):
+    from rio_pansharpen import verify
+    path = 'tests/fixtures/tiny_20_tiffs/LC81070352015122LGN00/'\
+           'LC81070352015122LGN00_B4.tif'
+    with rasterio.open(path) as src:
+        profile = src.profile
+        data = src.read()
+
+    copies = []
+    for name, offset in (('a.tif', 0), ('b.tif', 0), ('c.tif', 7)):
+        copy = str(tmpdir.join(name))
+        changed = data.copy()
+        changed[:, 600, 1100] += offset
+        with rasterio.open(copy, 'w', **profile) as dst:
+            dst.write(changed)
+        copies.append(copy)
+
+    manifests = [verify.write_checksums(copy) for copy in copies]
+    assert manifests[0] == copies[0] + '.checksums.json'
+    assert verify.compare_checksums(manifests[0], manifests[1]) == []
+    assert verify.compare_checksums(manifests[0], manifests[2]) == [
+        '512:1024,1024:1536']
+
+    diffs = verify.compare_outputs(copies[0], copies[2])
+    assert len(diffs) == 16
+    assert diffs['512:1024,1024:1536'] == 7
+    assert sum(diffs.values()) == 7
 
 
 def test_pansharpen_worker_uint16(test_pansharp_data):
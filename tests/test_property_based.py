@@ -5,11 +5,11 @@ import hypothesis.strategies as st
 from hypothesis.extra.numpy import arrays
 from rasterio.warp import reproject
 from rio_pansharpen.methods import(
-    calculateRatio, Brovey)
+    calculateRatio, Brovey, BroveyUint8)
 from rio_pansharpen.utils import(
     _adjust_block_size, _check_crs, _simple_mask,
     _pad_window, _create_apply_mask, _rescale,
-    _make_windows, _make_affine, _half_window)
+    _make_windows, _make_affine, _half_window, _split_window)
 
 
 # Testing _calculateRatio function from methods
@@ -29,6 +29,25 @@ def test_calculateRatio(rgb, pan, weight):
     assert np.array_equal(output, calculateRatio(rgb, pan, weight))
 
 
+# Testing _calculateRatio function with per-band weights
+@given(arrays(np.uint16, (5, 8, 8),
+              elements=st.integers(
+                min_value=1,
+                max_value=np.iinfo('uint16').max)
+              ),
+       arrays(np.uint16, (8, 8),
+              elements=st.integers(
+                min_value=1,
+                max_value=np.iinfo('uint16').max)
+              ),
+       st.lists(st.floats(min_value=0.2, max_value=1.0),
+                min_size=5, max_size=5))
+def test_calculateRatio_bands(rgb, pan, weights):
+    w = np.array(weights)
+    output = pan / ((rgb * w[:, None, None]).sum(axis=0) / w.sum())
+    assert np.allclose(output, calculateRatio(rgb, pan, weights), rtol=1e-5)
+
+
 # Testing Brovey function from methods
 @given(arrays(np.uint16, (3, 8, 8),
               elements=st.integers(
@@ -54,6 +73,32 @@ def test_Brovey(rgb, pan, weight, pan_dtype):
     assert np.array_equal(brovey_ratio, ratio)
 
 
+# Testing BroveyUint8 against Brovey followed by the 8 bit rescale
+@given(arrays(np.float32, (3, 8, 8),
+              elements=st.integers(
+                min_value=0,
+                max_value=np.iinfo('uint16').max)
+              ),
+       arrays(np.float32, (8, 8),
+              elements=st.integers(
+                min_value=0,
+                max_value=np.iinfo('uint16').max)
+              ),
+       st.floats(min_value=0.2, max_value=1.0))
+def test_BroveyUint8(rgb, pan, weight):
+    reference, ratio = Brovey(rgb, pan, weight, 'uint16')
+    sharp, valid = BroveyUint8(rgb, pan, weight)
+    assert sharp.dtype == np.uint8
+    assert np.all(np.abs(
+        sharp.astype(np.int32) -
+        (reference / 257.0).astype(np.uint8).astype(np.int32)) <= 1)
+    # alpha may only differ where float rounding straddles 1 DN
+    with np.errstate(invalid='ignore'):
+        brightest = np.max(ratio * rgb, axis=0)
+    differ = valid != np.any(reference != 0, axis=0)
+    assert np.all(np.isclose(brightest[differ], 1, rtol=1e-4))
+
+
 # Testing _fix_window_size function from utils
 @given(
     st.integers(min_value=1),
@@ -234,3 +279,18 @@ def test_half_window(window):
     assert np.all((np.array(window) % half_window) <= 1)
     assert window[0][0]/half_window[0][0] == 2
     assert window[-1][-1]/half_window[-1][-1] == 2
+
+
+# Testing _split_window function from utils
+@given(
+    st.integers(min_value=0, max_value=10000),
+    st.integers(min_value=0, max_value=10000),
+    st.integers(min_value=2, max_value=4096),
+    st.integers(min_value=2, max_value=4096))
+def test_split_window(row, col, height, width):
+    window = ((row, row + height), (col, col + width))
+    parts = _split_window(window)
+    assert len(parts) == 4
+    assert sum((p[0][1] - p[0][0]) * (p[1][1] - p[1][0])
+               for p in parts) == height * width
+    assert all(p[0][0] < p[0][1] and p[1][0] < p[1][1] for p in parts)